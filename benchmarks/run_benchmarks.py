@@ -0,0 +1,291 @@
+import os, sys, json, time, argparse, platform, tempfile, shutil, importlib
+import numpy as np
+import pandas as pd
+import utils.db_utils as db_utils
+from utils.profile_utils import reset_peak_rss, peak_rss_mb
+from benchmarks.synthetic_exports import (
+    CLIP_WORKFLOW,
+    FRAME_WORKFLOW,
+    SyntheticProject,
+    write_exports,
+    populate_db,
+)
+
+# Benchmark of the aggregation of Zooniverse classifications on synthetic exports.
+# Run from the root of the repository, e.g.
+#   python -m benchmarks.run_benchmarks -n 10000 100000 -o results.json
+
+STAGES = [
+    "export_download",
+    "csv_parse",
+    "json_flatten",
+    "subjects_uploaded",
+    "process_clips",
+    "process_frames",
+    "t13_get_exports",
+    "t13_process_clips",
+    "t13_process_frames",
+]
+
+# Stages that the later stages depend on, whose errors stop the benchmark
+REQUIRED_STAGES = ["subjects_uploaded"]
+
+# Google drive id standing for the synthetic list of duplicated subjects
+DUPLICATES_FILE_ID = "synthetic_duplicates"
+
+
+def run_stage(name, func, records, raise_errors=False):
+    """Run a stage of the benchmark, recording its time and memory
+    :param name: name of the stage
+    :param func: function running the stage, returning a sized output or a row count
+    :param records: list where the record of the stage is appended
+    :param raise_errors: raise the errors of the stage instead of recording them
+    :return: output of func, or None if it failed
+    """
+    reset_peak_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    record = {"stage": name}
+    output = None
+
+    try:
+        output = func()
+        if isinstance(output, (pd.DataFrame, pd.Series, list)):
+            record["rows"] = len(output)
+        elif isinstance(output, int):
+            record["rows"] = output
+    except Exception as e:
+        if raise_errors:
+            raise
+        record["error"] = repr(e)
+
+    record.update(
+        {
+            "wall_s": round(time.perf_counter() - wall, 4),
+            "cpu_s": round(time.process_time() - cpu, 4),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+    )
+    records.append(record)
+    print(
+        f"{name}: {record['wall_s']:.2f} s wall, {record['cpu_s']:.2f} s CPU, "
+        f"{record['peak_rss_mb']:.0f} MB peak"
+        + (f", failed with {record['error']}" if "error" in record else "")
+    )
+    return output
+
+
+def run_script(module_name, argv, project):
+    """Run the main function of a CLI script against the synthetic project"""
+    module = importlib.import_module(module_name)
+    module.auth_session = lambda user, password: project
+
+    old_argv = sys.argv
+    sys.argv = [module_name] + argv
+    try:
+        module.main()
+    finally:
+        sys.argv = old_argv
+
+
+def count_rows(conn, table):
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def benchmark(n_classifications, workdir, seed=0, stages=STAGES):
+    """Generate the exports of a given size and run the stages on them
+    :param n_classifications: number of classifications of the exports
+    :param workdir: folder for the exports, the cache and the database
+    :param seed: seed of the random generator
+    :param stages: names of the stages to run
+    :return: dict with the size of the exports and the records of the stages
+    """
+    from utils.export_utils import read_export, get_export, CLASSIFICATION_DTYPES
+    from utils.annotation_utils import decode_clip_annotations
+
+    folder = os.path.join(workdir, str(n_classifications))
+    db_path = os.path.join(folder, "koster_lab.db")
+    records = []
+
+    # Generate the exports and the database of the synthetic project
+    exports = run_stage(
+        "generate",
+        lambda: write_exports(folder, n_classifications, seed),
+        records,
+        raise_errors=True,
+    )
+    subjects = exports["subjects_df"]
+    conn = populate_db(db_path, subjects)
+    project = SyntheticProject(exports, project_id=f"synthetic_{n_classifications}")
+
+    # Serve the synthetic list of duplicated subjects instead of Google Drive
+    download_csv = db_utils.download_csv_from_google_drive
+    db_utils.download_csv_from_google_drive = lambda file_url: pd.read_csv(
+        exports["duplicates"]
+    )
+
+    user = ["-u", "synthetic", "-p", "synthetic", "-db", db_path]
+    context = {}
+    steps = {
+        "export_download": lambda: [
+            get_export(project, i, refresh=True)
+            for i in ["classifications", "subjects"]
+        ],
+        "csv_parse": lambda: context.setdefault(
+            "class_df",
+            read_export(
+                get_export(project, "classifications"),
+                usecols=[
+                    "classification_id",
+                    "subject_ids",
+                    "workflow_id",
+                    "workflow_version",
+                    "annotations",
+                ],
+                workflow_id=CLIP_WORKFLOW[0],
+                workflow_version=CLIP_WORKFLOW[1],
+                dtype=CLASSIFICATION_DTYPES,
+            ),
+        ),
+        "json_flatten": lambda: decode_clip_annotations(context["class_df"]),
+        "subjects_uploaded": lambda: run_script(
+            "db_setup.subjects_uploaded", user + ["-du", DUPLICATES_FILE_ID], project
+        )
+        or count_rows(conn, "subjects"),
+        "process_clips": lambda: run_script(
+            "db_setup.process_clips",
+            user
+            + [
+                "-du",
+                DUPLICATES_FILE_ID,
+                "-zw",
+                str(CLIP_WORKFLOW[0]),
+                "-zwv",
+                str(CLIP_WORKFLOW[1]),
+            ],
+            project,
+        )
+        or count_rows(conn, "agg_annotations_clip"),
+        "process_frames": lambda: run_script(
+            "db_setup.process_frames",
+            user
+            + [
+                "-du",
+                DUPLICATES_FILE_ID,
+                "-zw",
+                str(FRAME_WORKFLOW[0]),
+                "-zwv",
+                str(FRAME_WORKFLOW[1]),
+            ],
+            project,
+        )
+        or count_rows(conn, "agg_annotations_frame"),
+        "t13_get_exports": lambda: context.setdefault("t13", t13_get_exports(project))[
+            0
+        ],
+        "t13_process_clips": lambda: t13_utils().process_clips(
+            context["t13"][0], context["t13"][1], *CLIP_WORKFLOW
+        ),
+        "t13_process_frames": lambda: t13_utils().process_frames(
+            db_path, context["t13"][0], *FRAME_WORKFLOW, DUPLICATES_FILE_ID
+        ),
+    }
+
+    try:
+        for stage in stages:
+            run_stage(
+                stage, steps[stage], records, raise_errors=stage in REQUIRED_STAGES
+            )
+    finally:
+        db_utils.download_csv_from_google_drive = download_csv
+
+    return {
+        "n_classifications": n_classifications,
+        "n_subjects": len(subjects),
+        "n_duplicates": int(subjects["single_subject_id"].notnull().sum()),
+        "export_mb": round(os.path.getsize(exports["classifications"]) / 2**20, 2),
+        "stages": records,
+    }
+
+
+def t13_utils():
+    return importlib.import_module("notebooks.tutorials.tutorial_utils.t13_utils")
+
+
+def t13_get_exports(project):
+    module = t13_utils()
+    module.auth_session = lambda user, password: project
+    return module.get_exports("synthetic", "synthetic")
+
+
+def main():
+    "Handles argument parsing and launches the correct function."
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--n_classifications",
+        type=int,
+        nargs="+",
+        help="sizes of the classifications exports to benchmark",
+        default=[10000],
+    )
+    parser.add_argument(
+        "-s", "--seed", type=int, help="seed of the synthetic exports", default=0
+    )
+    parser.add_argument(
+        "-st",
+        "--stages",
+        type=str,
+        nargs="+",
+        help="stages to run",
+        choices=STAGES,
+        default=STAGES,
+    )
+    parser.add_argument(
+        "-w",
+        "--workdir",
+        type=str,
+        help="folder for the exports and databases, a temporary folder by default",
+        default=None,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="path of the JSON file with the results",
+        default=r"benchmark_results.json",
+    )
+
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="koster_benchmark_")
+
+    # Keep the exports of the benchmark apart from the real export cache
+    os.environ["KOSTER_EXPORT_CACHE"] = os.path.join(workdir, "export_cache")
+
+    try:
+        runs = []
+        for n in args.n_classifications:
+            print(f"Benchmarking {n} classifications")
+            runs.append(benchmark(n, workdir, args.seed, args.stages))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "seed": args.seed,
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
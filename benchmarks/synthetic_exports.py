@@ -0,0 +1,509 @@
+import os, io, json, gzip, time
+import numpy as np
+import pandas as pd
+import utils.db_utils as db_utils
+from db_setup import schema
+
+# Seeded generator of Zooniverse exports shaped like those of the koster project,
+# to measure the aggregation scripts offline
+
+# Workflows (id, version) of the clip and frame classifications
+CLIP_WORKFLOW = (11767, 227.0)
+FRAME_WORKFLOW = (12852, 21.85)
+
+# Movies and species of the synthetic database, ids follow the order of the lists
+MOVIE_NAMES = [
+    f"{'Väderöarna' if i % 5 == 0 else 'Koster'}_M{i:03d}" for i in range(1, 61)
+]
+SPECIES_NAMES = [
+    "Deep-sea king crab",
+    "Sea pen",
+    "Cod",
+    "Ling",
+    "Tusk",
+    "Lophelia pertusa",
+    "Sea star",
+    "Sea urchin",
+    "Anemone",
+    "Flat fish",
+    "Shrimp",
+    "Sponge",
+]
+
+# Number of users classifying each subject, and columns of the exports
+USERS_PER_SUBJECT = (3, 12)
+CLASSIFICATION_COLUMNS = [
+    "classification_id",
+    "user_name",
+    "user_id",
+    "workflow_id",
+    "workflow_name",
+    "workflow_version",
+    "created_at",
+    "gold_standard",
+    "expert",
+    "metadata",
+    "annotations",
+    "subject_data",
+    "subject_ids",
+]
+SUBJECT_COLUMNS = [
+    "subject_id",
+    "project_id",
+    "workflow_id",
+    "subject_set_id",
+    "metadata",
+    "locations",
+    "classifications_count",
+    "retired_at",
+    "retirement_reason",
+    "created_at",
+    "updated_at",
+]
+
+# Subjects are uploaded automatically after this date, and manually before it
+FIRST_AUTO_UPLOAD = pd.Timestamp("2020-06-01")
+FIRST_MANUAL_UPLOAD = pd.Timestamp("2019-12-01")
+
+
+def choice_label(name):
+    """Get the Zooniverse choice of a species, e.g. "Sea pen" -> "SEAPEN" """
+    return name.replace("(", "").replace(")", "").replace(" ", "").upper()
+
+
+def timestamp(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(seconds))
+
+
+def make_subjects(
+    n_classifications, seed=0, frame_share=0.5, duplicate_share=0.02, manual_share=0.05
+):
+    """Draw the subjects of the project and the number of classifications of each
+    :param n_classifications: total number of classifications of the subjects
+    :param seed: seed of the random generator
+    :param frame_share: proportion of frame subjects, the rest are clips
+    :param duplicate_share: proportion of subjects that duplicate another subject
+    :param manual_share: proportion of clips uploaded manually
+    :return: data frame with a row per subject
+    """
+    rng = np.random.RandomState(seed)
+
+    # Draw the number of users of each subject until all the classifications are assigned
+    n_subjects = n_classifications // USERS_PER_SUBJECT[0] + 1
+    n_users = rng.randint(USERS_PER_SUBJECT[0], USERS_PER_SUBJECT[1] + 1, n_subjects)
+    n_subjects = int(np.searchsorted(np.cumsum(n_users), n_classifications)) + 1
+    n_users = n_users[:n_subjects]
+    n_users[-1] -= n_users.sum() - n_classifications
+
+    subjects = pd.DataFrame(
+        {
+            "subject_id": np.arange(n_subjects) + 30000000,
+            "n_users": n_users,
+            "subject_type": np.where(
+                rng.rand(n_subjects) < frame_share, "frame", "clip"
+            ),
+            "movie_id": rng.randint(1, len(MOVIE_NAMES) + 1, n_subjects),
+            "species_id": rng.randint(1, len(SPECIES_NAMES) + 1, n_subjects),
+            "clip_start_time": rng.randint(0, 360, n_subjects) * 10,
+            "retired": rng.rand(n_subjects) < 0.9,
+        }
+    )
+    subjects["frame_number"] = subjects["clip_start_time"] * 25 + rng.randint(
+        0, 250, n_subjects
+    )
+    subjects["manual"] = (subjects["subject_type"] == "clip") & (
+        rng.rand(n_subjects) < manual_share
+    )
+    first_upload = np.where(
+        subjects["manual"],
+        FIRST_MANUAL_UPLOAD.timestamp(),
+        FIRST_AUTO_UPLOAD.timestamp(),
+    )
+    subjects["created_at"] = first_upload + rng.randint(0, 60 * 86400, n_subjects)
+
+    # Make some subjects copies of another subject of the same type
+    subjects["single_subject_id"] = np.nan
+    for subject_type, group in subjects.groupby("subject_type"):
+        dupl = group.index[rng.rand(len(group)) < duplicate_share]
+        pool = group.index.difference(dupl)
+        if len(dupl) == 0 or len(pool) == 0:
+            continue
+        single = rng.choice(pool, len(dupl))
+        for col in ["movie_id", "species_id", "clip_start_time", "frame_number"]:
+            subjects.loc[dupl, col] = subjects.loc[single, col].values
+        subjects.loc[dupl, "single_subject_id"] = subjects.loc[
+            single, "subject_id"
+        ].values
+
+    subjects["label"] = [SPECIES_NAMES[i - 1] for i in subjects["species_id"]]
+    subjects["movie_filename"] = [MOVIE_NAMES[i - 1] for i in subjects["movie_id"]]
+    subjects["workflow_id"] = np.where(
+        subjects["subject_type"] == "frame", FRAME_WORKFLOW[0], CLIP_WORKFLOW[0]
+    )
+    subjects["filename"] = np.where(
+        subjects["subject_type"] == "frame",
+        subjects["movie_filename"]
+        + "_"
+        + subjects["frame_number"].astype(str)
+        + ".jpg",
+        subjects["movie_filename"]
+        + "_"
+        + subjects["clip_start_time"].astype(str)
+        + ".mp4",
+    )
+
+    # Manual clip filenames must round-trip through subjects_uploaded, which
+    # removes "_<clip start>" from them to get the movie filename
+    clips = subjects[subjects["subject_type"] != "frame"]
+    parsed = [
+        filename.replace("_" + str(start), "").replace(".mp4", "")
+        for filename, start in clips[["filename", "clip_start_time"]].values
+    ]
+    assert parsed == clips["movie_filename"].tolist(), "Clip filenames do not round-trip"
+
+    return subjects
+
+
+def retired_block(subject, retired_at):
+    if not subject.retired:
+        return None
+    return {
+        "id": int(subject.subject_id) - 20000000,
+        "workflow_id": int(subject.workflow_id),
+        "classifications_count": int(subject.n_users),
+        "created_at": timestamp(subject.created_at),
+        "updated_at": timestamp(retired_at),
+        "retired_at": timestamp(retired_at),
+        "subject_id": int(subject.subject_id),
+        "retirement_reason": "classification_count",
+    }
+
+
+def subject_data(subject, retired_at):
+    """Get the subject_data column of the classifications of a subject"""
+    data = {"retired": retired_block(subject, retired_at)}
+    if subject.subject_type == "frame":
+        data.update(
+            {
+                "movie_id": int(subject.movie_id),
+                "frame_number": int(subject.frame_number),
+                "label": subject.label,
+                "frame_exp_sp_id": int(subject.species_id),
+                "subject_type": "frame",
+            }
+        )
+    else:
+        data.update(
+            {
+                "movie_id": int(subject.movie_id),
+                "clip_start_time": int(subject.clip_start_time),
+                "clip_end_time": int(subject.clip_start_time) + 10,
+                "filename": subject.filename,
+                "subject_type": "clip",
+            }
+        )
+    return json.dumps({str(int(subject.subject_id)): data})
+
+
+def clip_annotations(rng, species_id, n):
+    """Get the T4 species choices of n classifications of a clip"""
+    annotations = []
+    for _ in range(n):
+        if rng.rand() < 0.2:
+            values = [{"choice": "NOTHINGHERE", "answers": {}, "filters": {}}]
+        else:
+            species = [species_id] + list(
+                rng.randint(1, len(SPECIES_NAMES) + 1, rng.randint(0, 2))
+            )
+            values = [
+                {
+                    "choice": choice_label(SPECIES_NAMES[i - 1]),
+                    "answers": {
+                        "HOWMANYINDIVIDUALSDOYOUSEE": str(rng.randint(1, 6)),
+                        "WHENDIDYOUSEEITFORTHEFIRSTTIME": f"{rng.randint(0, 10)}S",
+                    },
+                    "filters": {},
+                }
+                for i in dict.fromkeys(species)
+            ]
+        annotations.append(
+            json.dumps([{"task": "T4", "task_label": None, "value": values}])
+        )
+    return annotations
+
+
+def frame_annotations(rng, n):
+    """Get the bounding boxes drawn by n users on a frame"""
+    # Place 0 to 3 objects in the frame, that users find with some jitter
+    objects = rng.rand(rng.randint(0, 4), 4) * [1000, 600, 200, 200] + [0, 0, 20, 20]
+    annotations = []
+    for _ in range(n):
+        boxes = [
+            {
+                "x": round(x + rng.normal(0, 4), 2),
+                "y": round(y + rng.normal(0, 4), 2),
+                "tool": 0,
+                "frame": 0,
+                "width": round(max(w + rng.normal(0, 4), 1), 2),
+                "height": round(max(h + rng.normal(0, 4), 1), 2),
+                "details": [],
+                "tool_label": "Species",
+            }
+            for x, y, w, h in objects
+            if rng.rand() < 0.85
+        ]
+        annotations.append(
+            json.dumps(
+                [
+                    {
+                        "task": "T0",
+                        "task_label": "Draw a box around each animal",
+                        "value": boxes,
+                    }
+                ]
+            )
+        )
+    return annotations
+
+
+def iter_classifications(subjects, seed=0, chunk_subjects=10000):
+    """Generate the classifications export of the subjects in chunks
+    :param subjects: data frame of make_subjects
+    :param seed: seed of the random generator
+    :param chunk_subjects: number of subjects per chunk
+    :return: generator of data frames with CLASSIFICATION_COLUMNS
+    """
+    rng = np.random.RandomState(seed + 1)
+    classification_id = 200000000
+    n_names = max(len(subjects) // 3, 50)
+
+    for start in range(0, len(subjects), chunk_subjects):
+        rows = []
+        for subject in subjects.iloc[start : start + chunk_subjects].itertuples():
+            n = int(subject.n_users)
+            times = subject.created_at + np.sort(rng.randint(3600, 30 * 86400, n))
+            data = subject_data(subject, times[-1])
+            users = (
+                rng.choice(n_names, n, replace=False)
+                if n <= n_names
+                else rng.randint(0, n_names, n)
+            )
+
+            if subject.subject_type == "frame":
+                workflow, annotations = FRAME_WORKFLOW, frame_annotations(rng, n)
+            else:
+                workflow = CLIP_WORKFLOW
+                annotations = clip_annotations(rng, int(subject.species_id), n)
+
+            for i in range(n):
+                classification_id += 1
+                rows.append(
+                    (
+                        classification_id,
+                        f"citizen_{users[i]}",
+                        int(users[i]) + 1000,
+                        workflow[0],
+                        (
+                            "Species identification"
+                            if workflow == CLIP_WORKFLOW
+                            else "Frame annotation"
+                        ),
+                        workflow[1],
+                        timestamp(times[i]),
+                        None,
+                        None,
+                        '{"source":"api","session":"%016x","viewport":{"width":1280,"height":720}}'
+                        % rng.randint(0, 2**62),
+                        annotations[i],
+                        data,
+                        int(subject.subject_id),
+                    )
+                )
+
+        yield pd.DataFrame(rows, columns=CLASSIFICATION_COLUMNS)
+
+
+def subjects_export(subjects):
+    """Get the subjects export of the project"""
+    metadata = [
+        (
+            json.dumps({"filename": s.filename})
+            if s.manual
+            else json.dumps(
+                {
+                    "subject_type": s.subject_type,
+                    "filename": s.filename,
+                    "clip_start_time": (
+                        None if s.subject_type == "frame" else int(s.clip_start_time)
+                    ),
+                    "clip_end_time": (
+                        None
+                        if s.subject_type == "frame"
+                        else int(s.clip_start_time) + 10
+                    ),
+                    "frame_exp_sp_id": (
+                        int(s.species_id) if s.subject_type == "frame" else None
+                    ),
+                    "frame_number": (
+                        int(s.frame_number) if s.subject_type == "frame" else None
+                    ),
+                    "movie_id": int(s.movie_id),
+                }
+            )
+        )
+        for s in subjects.itertuples()
+    ]
+    retired_at = [
+        timestamp(s.created_at + 30 * 86400) if s.retired else None
+        for s in subjects.itertuples()
+    ]
+    return pd.DataFrame(
+        {
+            "subject_id": subjects["subject_id"],
+            "project_id": 9747,
+            "workflow_id": subjects["workflow_id"],
+            "subject_set_id": 80000 + subjects["movie_id"],
+            "metadata": metadata,
+            "locations": [
+                json.dumps(
+                    {
+                        "0": f"https://panoptes-uploads.zooniverse.org/production/subject_location/{i}.{'jpeg' if t == 'frame' else 'mp4'}"
+                    }
+                )
+                for i, t in zip(subjects["subject_id"], subjects["subject_type"])
+            ],
+            "classifications_count": subjects["n_users"],
+            "retired_at": retired_at,
+            "retirement_reason": np.where(
+                subjects["retired"], "classification_count", None
+            ),
+            "created_at": [timestamp(i) for i in subjects["created_at"]],
+            "updated_at": [timestamp(i) for i in subjects["created_at"]],
+        }
+    )[SUBJECT_COLUMNS]
+
+
+def duplicates_export(subjects):
+    """Get the list of duplicated subjects, as kept in Google Drive"""
+    dupl = subjects[subjects["single_subject_id"].notnull()]
+    return pd.DataFrame(
+        {
+            "dupl_subject_id": dupl["subject_id"].values,
+            "single_subject_id": dupl["single_subject_id"].astype(int).values,
+        }
+    )
+
+
+def write_exports(folder, n_classifications, seed=0, **kwargs):
+    """Write the synthetic exports of the project
+    :param folder: folder to store the exports
+    :param n_classifications: number of classifications of the export
+    :param seed: seed of the random generator
+    :param kwargs: arguments of make_subjects
+    :return: dict with the paths of the classifications, subjects and duplicates exports and the subjects data frame
+    """
+    os.makedirs(folder, exist_ok=True)
+    subjects = make_subjects(n_classifications, seed, **kwargs)
+
+    paths = {
+        "classifications": os.path.join(folder, "classifications.csv.gz"),
+        "subjects": os.path.join(folder, "subjects.csv.gz"),
+        "duplicates": os.path.join(folder, "duplicates.csv"),
+    }
+
+    # Write the classifications a chunk at a time to keep large exports out of memory
+    with gzip.open(paths["classifications"], "wt", encoding="utf-8", newline="") as f:
+        for i, chunk in enumerate(iter_classifications(subjects, seed)):
+            chunk.to_csv(f, index=False, header=i == 0)
+
+    subjects_export(subjects).to_csv(paths["subjects"], index=False)
+    duplicates_export(subjects).to_csv(paths["duplicates"], index=False)
+
+    return dict(paths, subjects_df=subjects)
+
+
+class SyntheticExport:
+    """Response of project.get_export streaming a synthetic export"""
+
+    def __init__(self, path):
+        self.raw = gzip.open(path, "rb")
+        self._content_consumed = False
+
+    @property
+    def content(self):
+        self._content_consumed = True
+        return self.raw.read()
+
+
+class SyntheticProject:
+    """Stand-in for the Zooniverse project serving the synthetic exports"""
+
+    def __init__(self, exports, project_id="synthetic"):
+        self.exports = exports
+        self.id = project_id
+        self.generated_at = timestamp(time.time())
+
+    def get_export(self, export_type, generate=False, wait=True):
+        return SyntheticExport(self.exports[export_type])
+
+    def describe_export(self, export_type):
+        return {"media": [{"updated_at": self.generated_at}]}
+
+
+def populate_db(db_path, subjects):
+    """Create a database with the movies, species and subjects of the synthetic project
+    :param db_path: path of the database file, replaced if it exists
+    :param subjects: data frame of make_subjects
+    :return: the Connection object
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    conn = db_utils.create_connection(db_path)
+    db_utils.execute_sql(conn, schema.sql)
+    db_utils.apply_migrations(conn, schema.migrations)
+
+    db_utils.upsert_many(
+        conn,
+        [
+            (
+                i + 1,
+                name,
+                "2019-01-01",
+                25,
+                3600,
+                "synthetic",
+                None,
+                f"/movies/{name}.mov",
+            )
+            for i, name in enumerate(MOVIE_NAMES)
+        ],
+        "movies",
+    )
+    db_utils.upsert_many(
+        conn, [(i + 1, name) for i, name in enumerate(SPECIES_NAMES)], "species"
+    )
+
+    frame = subjects["subject_type"] == "frame"
+    subjects_db = pd.DataFrame(
+        {
+            "id": subjects["subject_id"],
+            "subject_type": subjects["subject_type"],
+            "filename": subjects["filename"],
+            "clip_start_time": subjects["clip_start_time"].where(~frame),
+            "clip_end_time": (subjects["clip_start_time"] + 10).where(~frame),
+            "frame_exp_sp_id": subjects["species_id"].where(frame),
+            "frame_number": subjects["frame_number"].where(frame),
+            "workflow_id": subjects["workflow_id"].astype(str),
+            "subject_set_id": (80000 + subjects["movie_id"]).astype(str),
+            "classifications_count": subjects["n_users"],
+            "retired_at": None,
+            "retirement_reason": None,
+            "created_at": [timestamp(i) for i in subjects["created_at"]],
+            "movie_id": subjects["movie_id"],
+        }
+    ).astype(object)
+    subjects_db = subjects_db.where(subjects_db.notnull(), None)
+    db_utils.upsert_many(conn, [tuple(i) for i in subjects_db.values], "subjects")
+
+    return conn
@@ -4,19 +4,9 @@ import pandas as pd
 import sqlite3
 from datetime import datetime
 import utils.db_utils as db_utils
+from utils import resolver_utils, movie_utils
 
-def get_length(video_file):
-    final_fn = video_file if os.path.isfile(video_file) else db_utils.unswedify(video_file)
-    if os.path.isfile(final_fn):
-        cap = cv2.VideoCapture(final_fn)
-        fps = cap.get(cv2.CAP_PROP_FPS)     
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        length = frame_count/fps
-    else:
-        length, fps = None, None
-    return fps, length
-
-def add_new_movies(movies_file_id, db_path, movies_path):
+def add_new_movies(movies_file_id, db_path, movies_path, n_workers=8):
 
     # Download the csv with movies information from the google drive
     movies_df = db_utils.download_csv_from_google_drive(movies_file_id)
@@ -31,15 +21,15 @@ def add_new_movies(movies_file_id, db_path, movies_path):
     conn = db_utils.create_connection(db_path)
 
     # Reference with sites table
-    sites_df = pd.read_sql_query("SELECT id, name FROM sites", conn)
-    sites_df = sites_df.rename(columns={"id": "Site_id"})
-
-    movies_df = pd.merge(
-        movies_df, sites_df, how="left", left_on="SiteDescription", right_on="name"
+    movies_df["Site_id"] = resolver_utils.resolve(
+        conn, "sites", movies_df["SiteDescription"]
     )
 
     # Calculate the fps and length of the original movies
-    movies_df[["fps", "duration"]] = pd.DataFrame(movies_df["Fpath"].apply(get_length, 1).tolist(), columns=["fps", "duration"])
+    probes_df = movie_utils.probe_movies(
+        movies_df["Fpath"], conn, n_workers, roots=[movies_path]
+    )
+    movies_df["fps"], movies_df["duration"] = probes_df["fps"].values, probes_df["duration"].values
     
     # Select only those fields of interest
     movies_db = movies_df[
@@ -59,12 +49,10 @@ def add_species(species_file_id, db_path):
     # Create connection to db
     conn = db_utils.create_connection(db_path)
 
-    # Retrieve the id and label from the species table
-    uploaded_species = pd.read_sql_query("SELECT id, label FROM species", conn)
-    uploaded_species = uploaded_species.rename(columns={"id": "species_id"})
-
-    species_df["Fixed_Name"] = species_df["Name"].apply(lambda x: re.sub(r"[()\s]", "", x).lower(), 1)
-    species_df = species_df[~species_df["Fixed_Name"].isin([re.sub(r"[()\s]", "", i).lower() for i in uploaded_species["label"].unique()])]
+    # Select only the species that are not in the species table yet
+    species_df = species_df[
+        resolver_utils.resolve(conn, "species", species_df["Name"], report=False).isnull()
+    ]
 
     # Add values to species table
     db_utils.add_to_table(
@@ -2,7 +2,7 @@ import argparse
 import schema
 import sqlite3
 import sys
-from utils import db_utils
+from utils import db_utils, profile_utils
 
 # Initiate the database
 def main():
@@ -16,8 +16,12 @@ def main():
         default=r"koster_lab.db",
         required=True,
     )
+    profile_utils.add_arguments(p)
     args = p.parse_args()
 
+    # Measure the stages of the run if asked to
+    profile_utils.setup(args)
+
     sql_setup = schema.sql
 
     # create a database connection
@@ -27,6 +31,10 @@ def main():
     if conn is not None:
         # execute sql
         db_utils.execute_sql(conn, sql_setup)
+
+        # upgrade the tables to the latest version
+        version = db_utils.apply_migrations(conn, schema.migrations)
+        print(f"Database at version {version}")
     else:
         print("Error! cannot create the database connection.")
 
@@ -5,6 +5,14 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 import utils.db_utils as db_utils
+from utils.annotation_utils import decode_clip_annotations
+from utils import resolver_utils, profile_utils
+from utils.export_utils import (
+    read_export,
+    read_new_classifications,
+    get_export,
+    CLASSIFICATION_DTYPES,
+)
 from utils.zooniverse_utils import auth_session
 
 
@@ -65,39 +73,75 @@ def main():
         type=str,
         required=False,
     )
+    parser.add_argument(
+        "--refresh-exports",
+        help="download the Zooniverse exports even if they are cached",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "-inc",
+        "--incremental",
+        help="only aggregate subjects with classifications newer than the last run",
+        action="store_true",
+        required=False,
+    )
     
+    profile_utils.add_arguments(parser)
+
     args = parser.parse_args()
 
+    # Measure the stages of the run if asked to
+    profile_utils.setup(args)
+
     # Connect to the Zooniverse project
     project = auth_session(args.user, args.password)
 
     # Get the classifications from the project
-    export = project.get_export("classifications")
-
-    # Save the response as pandas data frame
-    class_df = pd.read_csv(
-        io.StringIO(export.content.decode("utf-8")),
-        usecols=[
-            "subject_ids",
-            "subject_data",
-            "classification_id",
-            "workflow_id",
-            "workflow_version",
-            "annotations",
-        ],
-    )
+    export = get_export(project, "classifications", refresh=args.refresh_exports)
 
-    
-    # Filter clip classifications
-    class_df = class_df[
-        (class_df.workflow_id == args.zoo_workflow)
-        & (class_df.workflow_version >= args.zoo_workflow_version)
-    ].reset_index()
-
-        ## Check if subjects have been uploaded
-    # Get species id for each species
+    # Connect to koster_db
     conn = db_utils.create_connection(args.db_path)
 
+    usecols = [
+        "subject_ids",
+        "subject_data",
+        "classification_id",
+        "workflow_id",
+        "workflow_version",
+        "annotations",
+    ]
+
+    if args.incremental:
+        # Save the clip classifications of subjects with new classifications as pandas data frame
+        class_df, updated_subjects, last_classification_id = read_new_classifications(
+            export,
+            usecols,
+            args.zoo_workflow,
+            args.zoo_workflow_version,
+            db_utils.get_last_classification_id(conn, args.zoo_workflow),
+            expand_subjects=(
+                lambda x: db_utils.expand_duplicates(x, args.duplicates_file_id)
+            )
+            if args.duplicates_file_id
+            else None,
+        )
+        class_df = class_df.reset_index()
+
+        if len(updated_subjects) == 0:
+            print("There are no new classifications to aggregate")
+            return
+    else:
+        # Save the clip classifications as pandas data frame
+        class_df = read_export(
+            export,
+            usecols=usecols,
+            workflow_id=args.zoo_workflow,
+            workflow_version=args.zoo_workflow_version,
+            dtype=CLASSIFICATION_DTYPES,
+        ).reset_index()
+
+    ## Check if subjects have been uploaded
     # Get subject table
     uploaded_subjects = pd.read_sql_query(
         "SELECT id FROM subjects WHERE subject_type='clip'", conn
@@ -111,11 +155,11 @@ def main():
     if len(new_subjects) > 0 and args.zoo_workflow not in [11767]:
 
         # Get info of subjects uploaded to the project
-        export = project.get_export("subjects")
+        export = get_export(project, "subjects", refresh=args.refresh_exports)
 
         # Save the subjects info as pandas data frame
-        subjects_df = pd.read_csv(
-            io.StringIO(export.content.decode("utf-8")),
+        subjects_df = read_export(
+            export,
             usecols=["subject_id", "subject_set_id", "created_at"],
         )
 
@@ -127,17 +171,13 @@ def main():
             right_on="subject_id",
         )
 
-        # Get movies table
-        movies_df = pd.read_sql_query(
-        "SELECT id, filename FROM movies", conn
-        )
-
         # Extract the video filename and annotation details
         new_subjects[
             [
                 "clip_start_time",
                 "clip_end_time", 
                 "movie_id",
+                "source_movie",
                 "classifications_count",
                 "created_at",
                 "retired_at",
@@ -150,7 +190,8 @@ def main():
                     {
                         "clip_start_time": v["clip_start_time"] if "clip_start_time" in v else (v["X.start_time"] if "X.start_time" in v else v["#start_time"]),
                         "clip_end_time": v["clip_end_time"] if "clip_end_time" in v else (v["X.end_time"] if "X.end_time" in v else v["#end_time"]),
-                        "movie_id": v["movie_id"] if "movie_id" in v else movies_df[movies_df.filename == v["filename"].rsplit('_', 1)[0]]['id'].values[0],
+                        "movie_id": v["movie_id"] if "movie_id" in v else None,
+                        "source_movie": v["filename"].rsplit('_', 1)[0] if "filename" in v else None,
                         "classifications_count": v["retired"]["classifications_count"],
                         "created_at": v["retired"]["created_at"],
                         "retired_at": v["retired"]["retired_at"],
@@ -162,6 +203,12 @@ def main():
             .tolist()
         )
 
+        # Find the movie of the subjects without movie_id from their filename
+        missing_movie = new_subjects["movie_id"].isnull()
+        new_subjects.loc[missing_movie, "movie_id"] = resolver_utils.resolve(
+            conn, "movies", new_subjects.loc[missing_movie, "source_movie"]
+        )
+
         new_subjects["subject_type"] = "clip"
         movies_df = pd.read_sql_query("SELECT id, filename FROM movies", conn)
         movies_df = movies_df.rename(
@@ -206,59 +253,16 @@ def main():
     class_df = class_df.drop(columns=["workflow_id", "workflow_version"])
 
     
-    # Create an empty list
-    rows_list = []
-
-    # Loop through each classification submitted by the users
-    for index, row in class_df.iterrows():
-        # Load annotations as json format
-        annotations = json.loads(row["annotations"])
-
-        # Select the information from the species identification task
-        for ann_i in annotations:
-            if ann_i["task"] == "T4":
-
-                # Select each species annotated and flatten the relevant answers
-                for value_i in ann_i["value"]:
-                    choice_i = {}
-                    # If choice = 'nothing here', set follow-up answers to blank
-                    if value_i["choice"] == "NOTHINGHERE":
-                        f_time = ""
-                        inds = ""
-                    # If choice = species, flatten follow-up answers
-                    else:
-                        answers = value_i["answers"]
-                        for k in answers.keys():
-                            if "FIRSTTIME" in k:
-                                f_time = answers[k].replace("S", "")
-                            if "INDIVIDUAL" in k:
-                                inds = answers[k]
-
-                    # Save the species of choice, class and subject id
-                    choice_i.update(
-                        {
-                            "classification_id": row["classification_id"],
-                            "label": value_i["choice"],
-                            "first_seen": f_time,
-                            "how_many": inds,
-                        }
-                    )
-
-                    rows_list.append(choice_i)
-
-    # Create a data frame with annotations as rows
-    annot_df = pd.DataFrame(
-        rows_list, columns=["classification_id", "label", "first_seen", "how_many"]
-    )
+    # Flatten the species choices of each classification
+    annot_df = decode_clip_annotations(class_df)
 
-    # Specify the type of columns of the df
-    annot_df["how_many"] = pd.to_numeric(annot_df["how_many"])
-    annot_df["first_seen"] = pd.to_numeric(annot_df["first_seen"])
+    # Drop the raw JSON columns once they are decoded
+    class_df = class_df.drop(columns=["subject_data", "annotations"])
 
     # Add subject id to each annotation
     annot_df = pd.merge(
         annot_df,
-        class_df.drop(columns=["annotations"]),
+        class_df,
         how="left",
         on="classification_id",
     )
@@ -276,7 +280,7 @@ def main():
     annot_df = annot_df[annot_df.n_users >= args.n_users]
 
     # Calculate the proportion of users that agreed on their annotations
-    annot_df["class_n"] = annot_df.groupby(["subject_ids", "label"])[
+    annot_df["class_n"] = annot_df.groupby(["subject_ids", "label"], observed=True)[
         "classification_id"
     ].transform("count")
     annot_df["class_prop"] = annot_df.class_n / annot_df.n_users
@@ -285,25 +289,14 @@ def main():
     annot_df = annot_df[annot_df.class_prop >= args.aggr_thresh]
 
     # Extract the median of the second where the animal/object is and number of animals
-    annot_df = annot_df.groupby(["subject_ids", "label"], as_index=False)
+    annot_df = annot_df.groupby(["subject_ids", "label"], as_index=False, observed=True)
     annot_df = pd.DataFrame(annot_df[["how_many", "first_seen"]].median())
 
     # Create connection to db
     conn = db_utils.create_connection(args.db_path)
 
-    # Retrieve the id and label from the species table
-    speciesdf = pd.read_sql_query("SELECT id, label FROM species", conn)
-    speciesdf = speciesdf.rename(columns={"id": "species_id"})
-
-    # Match the label format of speciesdf to the annot_df
-    speciesdf["label"] = speciesdf["label"].apply(
-        lambda x: re.sub(r"[()\s]", "", x).upper(), 1
-    )
-
     # Add species_id to the classifications dataframe
-    annot_df = pd.merge(
-        annot_df, speciesdf, how="left", on="label", validate="many_to_one"
-    )
+    annot_df["species_id"] = resolver_utils.resolve(conn, "species", annot_df["label"])
 
     # Add index as id and rename the subject_id field
     annot_df = annot_df.reset_index().rename(
@@ -318,10 +311,25 @@ def main():
     # Check that the subject exists
     annot_df = annot_df[annot_df["subject_id"].isin(clipsdf["id"].unique())]
 
-    # Add annotations to the agg_annotations_clip table
-    db_utils.add_to_table(
-        args.db_path, "agg_annotations_clip", [(None,) + tuple(i) for i in annot_df.values], 5
-    )
+    if args.incremental:
+        # Replace the annotations of the updated subjects in the agg_annotations_clip table
+        db_utils.replace_subject_rows(
+            conn,
+            "agg_annotations_clip",
+            updated_subjects,
+            [(None,) + tuple(i) for i in annot_df.values],
+            5,
+        )
+        db_utils.set_last_classification_id(
+            conn, args.zoo_workflow, last_classification_id
+        )
+        conn.commit()
+        print(f"Updated agg_annotations_clip for {len(updated_subjects)} subjects")
+    else:
+        # Add annotations to the agg_annotations_clip table
+        db_utils.add_to_table(
+            args.db_path, "agg_annotations_clip", [(None,) + tuple(i) for i in annot_df.values], 5
+        )
 
 
 if __name__ == "__main__":
@@ -2,77 +2,20 @@ import os, io, csv, json
 import requests, argparse
 import pandas as pd
 import numpy as np
-from ast import literal_eval
 from datetime import datetime
 from panoptes_client import Project, Panoptes
-from collections import OrderedDict, Counter
-from sklearn.cluster import DBSCAN
 import utils.db_utils as db_utils
+from utils import profile_utils
+from utils.annotation_utils import decode_frame_annotations
+from utils.consensus_utils import aggregate_frame_boxes
+from utils.export_utils import (
+    read_export,
+    read_new_classifications,
+    get_export,
+    CLASSIFICATION_DTYPES,
+)
 from utils.zooniverse_utils import auth_session
 
-def bb_iou(boxA, boxB):
-
-    # Compute edges
-    temp_boxA = boxA.copy()
-    temp_boxB = boxB.copy()
-    temp_boxA[2], temp_boxA[3] = (
-        temp_boxA[0] + temp_boxA[2],
-        temp_boxA[1] + temp_boxA[3],
-    )
-    temp_boxB[2], temp_boxB[3] = (
-        temp_boxB[0] + temp_boxB[2],
-        temp_boxB[1] + temp_boxB[3],
-    )
-
-    # determine the (x, y)-coordinates of the intersection rectangle
-    xA = max(temp_boxA[0], temp_boxB[0])
-    yA = max(temp_boxA[1], temp_boxB[1])
-    xB = min(temp_boxA[2], temp_boxB[2])
-    yB = min(temp_boxA[3], temp_boxB[3])
-
-    # compute the area of intersection rectangle
-    interArea = abs(max((xB - xA, 0)) * max((yB - yA), 0))
-    if interArea == 0:
-        return 1
-    # compute the area of both the prediction and ground-truth
-    # rectangles
-    boxAArea = abs((temp_boxA[2] - temp_boxA[0]) * (temp_boxA[3] - temp_boxA[1]))
-    boxBArea = abs((temp_boxB[2] - temp_boxB[0]) * (temp_boxB[3] - temp_boxB[1]))
-
-    # compute the intersection over union by taking the intersection
-    # area and dividing it by the sum of prediction + ground-truth
-    # areas - the intersection area
-    iou = interArea / float(boxAArea + boxBArea - interArea)
-
-    # return the intersection over union value
-    return 1 - iou
-
-
-def filter_bboxes(total_users, users, bboxes, obj, eps, iua):
-
-    # If at least half of those who saw this frame decided that there was an object
-    user_count = pd.Series(users).nunique()
-    if user_count / total_users >= obj:
-        # Get clusters of annotation boxes based on iou criterion
-        cluster_ids = DBSCAN(min_samples=1, metric=bb_iou, eps=eps).fit_predict(bboxes)
-        # Count the number of users within each cluster
-        counter_dict = Counter(cluster_ids)
-        # Accept a cluster assignment if at least 80% of users agree on annotation
-        passing_ids = [k for k, v in counter_dict.items() if v / user_count >= iua]
-
-        indices = np.isin(cluster_ids, passing_ids)
-
-        final_boxes = []
-        for i in passing_ids:
-            # Compute median over all accepted bounding boxes
-            boxes = np.median(np.array(bboxes)[np.where(cluster_ids == i)], axis=0)
-            final_boxes.append(boxes)
-
-        return indices, final_boxes
-
-    else:
-        return [], bboxes
-
 
 def main():
     "Handles argument parsing and launches the correct function."
@@ -143,34 +86,78 @@ def main():
         type=str,
         required=False,
     )
+    parser.add_argument(
+        "--refresh-exports",
+        help="download the Zooniverse exports even if they are cached",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "-inc",
+        "--incremental",
+        help="only aggregate subjects with classifications newer than the last run",
+        action="store_true",
+        required=False,
+    )
+
+    profile_utils.add_arguments(parser)
 
     args = parser.parse_args()
 
+    # Measure the stages of the run if asked to
+    profile_utils.setup(args)
+
     project = auth_session(args.user, args.password)
 
     # Get the export classifications
-    export = project.get_export("classifications")
-
-    # Save the response as pandas data frame
-    rawdata = pd.read_csv(
-        io.StringIO(export.content.decode("utf-8")),
-        usecols=[
-            "user_name",
-            "subject_ids",
-            "subject_data",
-            "classification_id",
-            "workflow_id",
-            "workflow_version",
-            "created_at",
-            "annotations",
-        ],
-    )
+    export = get_export(project, "classifications", refresh=args.refresh_exports)
+
+    # Connect to koster_db
+    conn = db_utils.create_connection(args.db_path)
+
+    usecols = [
+        "user_name",
+        "subject_ids",
+        "subject_data",
+        "classification_id",
+        "workflow_id",
+        "workflow_version",
+        "annotations",
+    ]
 
-    # Filter w2 classifications
-    w2_data = rawdata[
-        (rawdata.workflow_id == args.zoo_workflow)
-        & (rawdata.workflow_version >= args.zoo_workflow_version)
-    ].reset_index()
+    if args.incremental:
+        # Save the w2 classifications of subjects with new classifications as pandas data frame
+        w2_data, updated_subjects, last_classification_id = read_new_classifications(
+            export,
+            usecols,
+            args.zoo_workflow,
+            args.zoo_workflow_version,
+            db_utils.get_last_classification_id(conn, args.zoo_workflow),
+            expand_subjects=(
+                lambda x: db_utils.expand_duplicates(x, args.duplicates_file_id)
+            )
+            if args.duplicates_file_id
+            else None,
+        )
+        w2_data = w2_data.reset_index()
+
+        if len(updated_subjects) == 0:
+            print("There are no new classifications to aggregate")
+            return
+    else:
+        # Save the w2 classifications as pandas data frame
+        w2_data = read_export(
+            export,
+            usecols=usecols,
+            workflow_id=args.zoo_workflow,
+            workflow_version=args.zoo_workflow_version,
+            dtype=CLASSIFICATION_DTYPES,
+        ).reset_index()
+
+        # Keep the last classification read, to record the aggregation
+        last_classification_id = (
+            w2_data["classification_id"].max() if len(w2_data) > 0 else None
+        )
 
     # Clear duplicated subjects
     if args.duplicates_file_id:
@@ -180,9 +167,6 @@ def main():
     w2_data = w2_data.drop(['dupl_subject_id', 'single_subject_id'], 1)
 
     ## Check if subjects have been uploaded
-    # Get species id for each species
-    conn = db_utils.create_connection(args.db_path)
-
     # Get subject table
     uploaded_subjects = pd.read_sql_query(
         "SELECT id FROM subjects WHERE subject_type='frame'", conn
@@ -196,11 +180,11 @@ def main():
     if len(new_subjects) > 0 and args.zoo_workflow_version > 30:
 
         # Get info of subjects uploaded to the project
-        export = project.get_export("subjects")
+        export = get_export(project, "subjects", refresh=args.refresh_exports)
 
         # Save the subjects info as pandas data frame
-        subjects_df = pd.read_csv(
-            io.StringIO(export.content.decode("utf-8")),
+        subjects_df = read_export(
+            export,
             usecols=["subject_id", "subject_set_id", "created_at"],
         )
 
@@ -296,161 +280,18 @@ def main():
             "workflow_id",
             "workflow_version",
             "n_users",
-            "created_at",
-        ]
-    )
-
-    # Extract the video filename and annotation details
-    subject_data_df = pd.DataFrame(
-        w2_data["subject_data"]
-        .apply(
-            lambda x: [
-                {
-                    "movie_id": v["movie_id"],
-                    "frame_number": v["frame_number"],
-                    "label": v["label"],
-                }
-                for k, v in json.loads(x).items()  # if v['retired']
-            ][0],
-            1,
-        )
-        .tolist()
-    )
-
-    w2_data = pd.concat(
-        [w2_data.reset_index().drop("index", 1), subject_data_df],
-        axis=1,
-        ignore_index=True,
-    )
-    w2_data = w2_data[w2_data.columns[1:]]
-    pd.set_option('display.max_columns', None)
-
-    w2_data.columns = [
-        "classification_id",
-        "user_name",
-        "annotations",
-        "subject_data",
-        "subject_ids",
-        "movie_id",
-        "frame_number",
-        "label",
-    ]
-
-    movies_df = pd.read_sql_query("SELECT id, filename FROM movies", conn)
-    movies_df = movies_df.rename(columns={"id": "movie_id"})
-
-    w2_data = pd.merge(w2_data, movies_df, how="left", on="movie_id")
-
-    # Convert to dictionary entries
-    w2_data["movie_id"] = w2_data["movie_id"].apply(lambda x: {"movie_id": x})
-    w2_data["frame_number"] = w2_data["frame_number"].apply(
-        lambda x: {"frame_number": x}
-    )
-    w2_data["label"] = w2_data["label"].apply(lambda x: {"label": x})
-    w2_data["user_name"] = w2_data["user_name"].apply(lambda x: {"user_name": x})
-    w2_data["subject_id"] = w2_data["subject_ids"].apply(lambda x: {"subject_id": x})
-    w2_data["annotation"] = w2_data["annotations"].apply(
-        lambda x: literal_eval(x)[0]["value"], 1
-    )
-
-    # Extract annotation metadata
-    w2_data["annotation"] = w2_data[
-        ["movie_id", "frame_number", "label", "annotation", "user_name", "subject_id"]
-    ].apply(
-        lambda x: [
-            OrderedDict(
-                list(x["movie_id"].items())
-                + list(x["frame_number"].items())
-                + list(x["label"].items())
-                + list(x["annotation"][i].items())
-                + list(x["user_name"].items())
-                + list(x["subject_id"].items())
-            )
-            for i in range(len(x["annotation"]))
         ]
-        if len(x["annotation"]) > 0
-        else [
-            OrderedDict(
-                list(x["movie_id"].items())
-                + list(x["frame_number"].items())
-                + list(x["label"].items())
-                + list(x["user_name"].items())
-                + list(x["subject_id"].items())
-            )
-        ],
-        1,
     )
 
-    # Convert annotation to format which the tracker expects
-    ds = [
-        OrderedDict(
-            {
-                "user": i["user_name"],
-                "movie_id": i["movie_id"],
-                "label": i["label"],
-                "start_frame": i["frame_number"],
-                "x": int(i["x"]) if "x" in i else None,
-                "y": int(i["y"]) if "y" in i else None,
-                "w": int(i["width"]) if "width" in i else None,
-                "h": int(i["height"]) if "height" in i else None,
-                "subject_id": i["subject_id"] if "subject_id" in i else None,
-            }
-        )
-        for i in w2_data.annotation.explode()
-        if i is not None and i is not np.nan
-    ]
-
-    # Get prepared annotations
-    w2_full = pd.DataFrame(ds)
-    w2_annotations = w2_full[w2_full["x"].notnull()]
-
-    new_rows = []
-    final_indices = []
-    for name, group in w2_annotations.groupby(["movie_id", "label", "start_frame"]):
-        movie_id, label, start_frame = name
-
-        total_users = w2_full[
-            (w2_full.movie_id == movie_id)
-            & (w2_full.label == label)
-            & (w2_full.start_frame == start_frame)
-        ]["user"].nunique()
-
-        # Filter bboxes using IOU metric (essentially a consensus metric)
-        # Keep only bboxes where mean overlap exceeds this threshold
-        indices, new_group = filter_bboxes(
-            total_users=total_users,
-            users=[i[0] for i in group.values],
-            bboxes=[np.array((i[4], i[5], i[6], i[7])) for i in group.values],
-            obj=args.object_thresh,
-            eps=args.iou_epsilon,
-            iua=args.inter_user_agreement,
-        )
+    # Flatten the boxes drawn by each user into a row per box
+    w2_full = decode_frame_annotations(w2_data)
 
-        subject_ids = [i[8] for i in group.values[indices]]
-
-        for ix, box in zip(subject_ids, new_group):
-            new_rows.append(
-                (
-                    movie_id,
-                    label,
-                    start_frame,
-                    ix,
-                )
-                + tuple(box)
-            )
+    # Free the raw JSON columns once they are decoded
+    del w2_data
 
-    w2_annotations = pd.DataFrame(
-        new_rows,
-        columns=[
-            "movie_id",
-            "label",
-            "start_frame",
-            "subject_id",
-            "x",
-            "y",
-            "w",
-            "h",
-        ],
+    # Reach a consensus on the boxes drawn on each frame
+    w2_annotations = aggregate_frame_boxes(
+        w2_full, args.object_thresh, args.iou_epsilon, args.inter_user_agreement
     )
 
     # Get species id for each species
@@ -477,13 +318,34 @@ def main():
         ["species_id", "x", "y", "w", "h", "subject_id"]
     ]
 
-    # Add values to agg_annotations_frame
-    db_utils.add_to_table(
-        args.db_path,
-        "agg_annotations_frame",
-        [(None,) + tuple(i) for i in w2_annotations.values],
-        7,
-    )
+    if args.incremental:
+        # Replace the annotations of the updated subjects in agg_annotations_frame
+        db_utils.replace_subject_rows(
+            conn,
+            "agg_annotations_frame",
+            updated_subjects,
+            [(None,) + tuple(i) for i in w2_annotations.values],
+            7,
+        )
+        db_utils.set_last_classification_id(
+            conn, args.zoo_workflow, last_classification_id
+        )
+        conn.commit()
+    else:
+        # Add values to agg_annotations_frame
+        db_utils.add_to_table(
+            args.db_path,
+            "agg_annotations_frame",
+            [(None,) + tuple(i) for i in w2_annotations.values],
+            7,
+        )
+
+        # Record the aggregation, which also marks the frames drawn before it as outdated
+        if last_classification_id is not None:
+            db_utils.set_last_classification_id(
+                conn, args.zoo_workflow, last_classification_id
+            )
+            conn.commit()
 
     print(f"Frame Aggregation Complete: {len(w2_annotations)} annotations added")
 
@@ -103,3 +103,104 @@ FOREIGN KEY (movie_id) REFERENCES movies (id),
 FOREIGN KEY (species_id) REFERENCES species (id)
 );
 """
+
+# Ordered changes to the tables above, applied once to new and existing databases
+# and recorded in the schema_version table. Never edit a migration that has been
+# released, add a new one instead
+migrations = [
+    (
+        1,
+        "Track the last classification aggregated per workflow",
+        """CREATE TABLE IF NOT EXISTS aggregation_state
+(
+workflow_id integer PRIMARY KEY,
+last_classification_id integer NOT NULL,
+updated_at datetime NULL
+);
+""",
+    ),
+    (
+        2,
+        "Index the subjects and aggregated annotations queried by the upload scripts",
+        """CREATE INDEX IF NOT EXISTS idx_subjects_type_movie
+ON subjects (subject_type, movie_id, clip_start_time, clip_end_time);
+
+CREATE INDEX IF NOT EXISTS idx_subjects_frames
+ON subjects (movie_id, frame_number, frame_exp_sp_id);
+
+CREATE INDEX IF NOT EXISTS idx_subjects_frame_species
+ON subjects (frame_exp_sp_id, subject_type);
+
+CREATE INDEX IF NOT EXISTS idx_agg_clip_species
+ON agg_annotations_clip (species_id, subject_id, first_seen);
+
+CREATE INDEX IF NOT EXISTS idx_agg_frame_subject
+ON agg_annotations_frame (subject_id);
+""",
+    ),
+    (
+        3,
+        "Cache the stream facts of the movies probed",
+        """CREATE TABLE IF NOT EXISTS movie_probes
+(
+fpath text PRIMARY KEY,
+size integer NOT NULL,
+mtime real NOT NULL,
+fps real NULL,
+duration real NULL,
+frame_count integer NULL,
+codec text NULL,
+width integer NULL,
+height integer NULL,
+keyframe_interval real NULL,
+container_duration real NULL
+);
+""",
+    ),
+    (
+        4,
+        "Index the keyframe times of the movies to cut clips without re-encoding",
+        """CREATE TABLE IF NOT EXISTS movie_keyframes
+(
+fpath text PRIMARY KEY,
+size integer NOT NULL,
+mtime real NOT NULL,
+keyframes text NOT NULL
+);
+""",
+    ),
+    (
+        5,
+        "Audit the size and bitrate of the clips extracted for upload",
+        """CREATE TABLE IF NOT EXISTS clip_encodes
+(
+clip_path text PRIMARY KEY,
+movie_id integer NULL,
+clip_start_time integer NULL,
+clip_length integer NULL,
+size integer NULL,
+bitrate_kbps real NULL,
+copied integer NULL,
+attempts integer NULL,
+created_at datetime NULL,
+FOREIGN KEY (movie_id) REFERENCES movies (id)
+);
+""",
+    ),
+    (
+        6,
+        "Key the sites on their name so that re-ingesting them does not duplicate them",
+        """UPDATE movies SET site_id = (
+    SELECT MIN(b.id) FROM sites AS a JOIN sites AS b ON a.name = b.name
+    WHERE a.id = movies.site_id
+)
+WHERE site_id IN (SELECT id FROM sites WHERE name IS NOT NULL);
+
+DELETE FROM sites
+WHERE name IS NOT NULL
+AND id NOT IN (SELECT MIN(id) FROM sites WHERE name IS NOT NULL GROUP BY name);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sites_name ON sites (name);
+""",
+    ),
+]
@@ -4,19 +4,9 @@ import pandas as pd
 import sqlite3
 from datetime import datetime
 import utils.db_utils as db_utils
+from utils import resolver_utils, movie_utils, profile_utils
 
-def get_length(video_file):
-    final_fn = video_file if os.path.isfile(video_file) else db_utils.unswedify(video_file)
-    if os.path.isfile(final_fn):
-        cap = cv2.VideoCapture(final_fn)
-        fps = cap.get(cv2.CAP_PROP_FPS)     
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        length = frame_count/fps
-    else:
-        length, fps = None, None
-    return fps, length
-
-def add_movies(movies_file_id, db_path, movies_path):
+def add_movies(movies_file_id, db_path, movies_path, n_workers=8):
 
     # Download the csv with movies information from the google drive
     movies_df = db_utils.download_csv_from_google_drive(movies_file_id)
@@ -41,15 +31,16 @@ def add_movies(movies_file_id, db_path, movies_path):
     conn = db_utils.create_connection(db_path)
 
     # Reference with sites table
-    sites_df = pd.read_sql_query("SELECT id, name FROM sites", conn)
-    sites_df = sites_df.rename(columns={"id": "Site_id"})
-
-    movies_df = pd.merge(
-        movies_df, sites_df, how="left", left_on="SiteDecription", right_on="name"
+    resolver_utils.get_lookup(conn, "sites", refresh=True)
+    movies_df["Site_id"] = resolver_utils.resolve(
+        conn, "sites", movies_df["SiteDecription"]
     )
 
     # Calculate the fps and length of the original movies
-    movies_df[["fps", "duration"]] = pd.DataFrame(movies_df["Fpath"].apply(get_length, 1).tolist(), columns=["fps", "duration"])
+    probes_df = movie_utils.probe_movies(
+        movies_df["Fpath"], conn, n_workers, roots=[movies_path]
+    )
+    movies_df["fps"], movies_df["duration"] = probes_df["fps"].values, probes_df["duration"].values
     
     # Select only those fields of interest
     movies_db = movies_df[
@@ -105,10 +96,22 @@ def main():
         help="the absolute path to the movie files",
         default=r"/uploads",
     )
+    parser.add_argument(
+        "-nw",
+        "--n_workers",
+        type=int,
+        help="number of movies probed at the same time",
+        default=8,
+    )
+
+    profile_utils.add_arguments(parser)
 
     args = parser.parse_args()
 
-    add_movies(args.movies_file_id, args.db_path, args.movies_path)
+    # Measure the stages of the run if asked to
+    profile_utils.setup(args)
+
+    add_movies(args.movies_file_id, args.db_path, args.movies_path, args.n_workers)
     add_species(args.species_file_id, args.db_path)
 
 
@@ -7,6 +7,8 @@ import numpy as np
 from datetime import datetime
 from panoptes_client import Project, Panoptes
 import utils.db_utils as db_utils
+from utils import resolver_utils, profile_utils
+from utils.export_utils import read_export, get_export
 from utils.zooniverse_utils import auth_session
 
 # Function to extract the metadata from subjects
@@ -30,14 +32,8 @@ def get_movies_id(df, db_path):
     # Create connection to db
     conn = db_utils.create_connection(db_path)
 
-    # Query id and filenames from the movies table
-    movies_df = pd.read_sql_query("SELECT id, filename FROM movies", conn)
-    movies_df = movies_df.rename(
-        columns={"id": "movie_id", "filename": "movie_filename"}
-    )
-    
     # Reference the manually uploaded subjects with the movies table
-    df = pd.merge(df, movies_df, how="left", on="movie_filename")
+    df["movie_id"] = resolver_utils.resolve(conn, "movies", df["movie_filename"])
 
     # Drop the movie_filename column
     df = df.drop(columns=["movie_filename",])
@@ -127,18 +123,29 @@ def main():
         type=str,
         required=False,
     )
+    parser.add_argument(
+        "--refresh-exports",
+        help="download the Zooniverse exports even if they are cached",
+        action="store_true",
+        required=False,
+    )
+
+    profile_utils.add_arguments(parser)
 
     args = parser.parse_args()
 
+    # Measure the stages of the run if asked to
+    profile_utils.setup(args)
+
     # Connect to the Zooniverse project
     project = auth_session(args.user, args.password)
 
     # Get info of subjects uploaded to the project
-    export = project.get_export("subjects")
+    export = get_export(project, "subjects", refresh=args.refresh_exports)
 
     # Save the subjects info as pandas data frame
-    subjects_df = pd.read_csv(
-        io.StringIO(export.content.decode("utf-8")),
+    subjects_df = read_export(
+        export,
         usecols=[
             "subject_id",
             "metadata",
@@ -3,24 +3,28 @@ import numpy as np
 import json, io
 from ast import literal_eval
 from utils.zooniverse_utils import auth_session
-from db_setup.process_frames import filter_bboxes
+from utils.consensus_utils import aggregate_frame_boxes
 from utils import db_utils
-from collections import OrderedDict
+from utils.annotation_utils import (
+    decode_clip_annotations,
+    decode_frame_annotations,
+)
+from utils.export_utils import read_export, get_export, CLASSIFICATION_DTYPES
 from IPython.display import HTML, display, update_display, clear_output
 import ipywidgets as widgets
 
-def get_exports(user, password):
+def get_exports(user, password, refresh=False):
     
     # Connect to the Zooniverse project
     project = auth_session(user, password)
 
     # Get the classifications from the project
-    c_export = project.get_export("classifications")
-    s_export = project.get_export("subjects")
+    c_export = get_export(project, "classifications", refresh=refresh)
+    s_export = get_export(project, "subjects", refresh=refresh)
 
     # Save the response as pandas data frame
-    class_df = pd.read_csv(
-        io.StringIO(c_export.content.decode("utf-8")),
+    class_df = read_export(
+        c_export,
         usecols=[
             "user_name",
             "subject_ids",
@@ -31,11 +35,13 @@ def get_exports(user, password):
             "created_at",
             "annotations",
         ],
+        dtype=CLASSIFICATION_DTYPES,
     )
                 
 
-    subjects_df = pd.read_csv(
-        io.StringIO(s_export.content.decode("utf-8")),
+    subjects_df = read_export(
+        s_export,
+        usecols=["subject_id", "workflow_id", "locations"],
     )
                 
     total_df = pd.merge(class_df, subjects_df[["subject_id", "workflow_id", "locations"]], 
@@ -48,56 +54,9 @@ def get_exports(user, password):
 
 def process_clips(df: pd.DataFrame, class_df: pd.DataFrame, workflow_id: int, workflow_version: float):
     df = df[(df.workflow_id == workflow_id) & (df.workflow_version >= workflow_version)].reset_index()
-    # Create an empty list
-    rows_list = []
 
-    # Loop through each classification submitted by the users
-    for index, row in df.iterrows():
-        # Load annotations as json format
-        annotations = json.loads(row["annotations"])
-
-        # Select the information from the species identification task
-        for ann_i in annotations:
-            if ann_i["task"] == "T4":
-
-                # Select each species annotated and flatten the relevant answers
-                for value_i in ann_i["value"]:
-                    choice_i = {}
-                    # If choice = 'nothing here', set follow-up answers to blank
-                    if value_i["choice"] == "NOTHINGHERE":
-                        f_time = ""
-                        inds = ""
-                    # If choice = species, flatten follow-up answers
-                    else:
-                        answers = value_i["answers"]
-                        for k in answers.keys():
-                            if "FIRSTTIME" in k:
-                                f_time = answers[k].replace("S", "")
-                            if "INDIVIDUAL" in k:
-                                inds = answers[k]
-                            elif "FIRSTTIME" not in k and "INDIVIDUAL" not in k:
-                                f_time, inds = None, None
-
-                    # Save the species of choice, class and subject id
-                    choice_i.update(
-                        {
-                            "classification_id": row["classification_id"],
-                            "label": value_i["choice"],
-                            "first_seen": f_time,
-                            "how_many": inds,
-                        }
-                    )
-
-                    rows_list.append(choice_i)
-
-    # Create a data frame with annotations as rows
-    annot_df = pd.DataFrame(
-        rows_list, columns=["classification_id", "label", "first_seen", "how_many"]
-    )
-
-    # Specify the type of columns of the df
-    annot_df["how_many"] = pd.to_numeric(annot_df["how_many"])
-    annot_df["first_seen"] = pd.to_numeric(annot_df["first_seen"])
+    # Flatten the species choices of each classification
+    annot_df = decode_clip_annotations(df, reset_on_other_answers=True)
 
     # Add subject id to each annotation
     annot_df = pd.merge(
@@ -162,160 +121,13 @@ def process_frames(db_path: str, df: pd.DataFrame, workflow_id: int, workflow_ve
         ]
     )
     
-    # Extract the video filename and annotation details
-    subject_data_df = pd.DataFrame(
-        w2_data["subject_data"]
-        .apply(
-            lambda x: [
-                {
-                    "movie_id": v["movie_id"],
-                    "frame_number": v["frame_number"],
-                    "label": v["label"],
-                }
-                for k, v in json.loads(x).items()  # if v['retired']
-            ][0],
-            1,
-        )
-        .tolist()
-    )
+    # Flatten the boxes drawn by each user into a row per box
+    w2_full = decode_frame_annotations(w2_data)
 
-    w2_data = pd.concat(
-        [w2_data.reset_index().drop("index", 1), subject_data_df],
-        axis=1,
-        ignore_index=True,
-    )
-    
-    w2_data = w2_data[w2_data.columns[1:]]
-
-    w2_data.columns = [
-        "classification_id",
-        "user_name",
-        "annotations",
-        "subject_data",
-        "subject_ids",
-        "movie_id",
-        "frame_number",
-        "label",
-    ]
-
-    movies_df = pd.read_sql_query("SELECT id, filename FROM movies", conn)
-    movies_df = movies_df.rename(columns={"id": "movie_id"})
-    
-    w2_data = pd.merge(w2_data, movies_df, how="left", on="movie_id")
-
-    # Convert to dictionary entries
-    w2_data["movie_id"] = w2_data["movie_id"].apply(lambda x: {"movie_id": x})
-    w2_data["frame_number"] = w2_data["frame_number"].apply(
-        lambda x: {"frame_number": x}
-    )
-    w2_data["label"] = w2_data["label"].apply(lambda x: {"label": x})
-    w2_data["user_name"] = w2_data["user_name"].apply(lambda x: {"user_name": x})
-    w2_data["subject_id"] = w2_data["subject_ids"].apply(lambda x: {"subject_id": x})
-    
-    
-    w2_data["annotation"] = w2_data["annotations"].apply(
-        lambda x: literal_eval(x)[0]["value"], 1
-    )
-
-    # Extract annotation metadata
-    w2_data["annotation"] = w2_data[
-        ["movie_id", "frame_number", "label", "annotation", "user_name", "subject_id"]
-    ].apply(
-        lambda x: [
-            OrderedDict(
-                list(x["movie_id"].items())
-                + list(x["frame_number"].items())
-                + list(x["label"].items())
-                + list(x["annotation"][i].items())
-                + list(x["user_name"].items())
-                + list(x["subject_id"].items())
-            )
-            for i in range(len(x["annotation"]))
-        ]
-        if len(x["annotation"]) > 0
-        else [
-            OrderedDict(
-                list(x["movie_id"].items())
-                + list(x["frame_number"].items())
-                + list(x["label"].items())
-                + list(x["user_name"].items())
-                + list(x["subject_id"].items())
-            )
-        ],
-        1,
-    )
-
-    # Convert annotation to format which the tracker expects
-    ds = [
-        OrderedDict(
-            {
-                "user": i["user_name"],
-                "movie_id": i["movie_id"],
-                "label": i["label"],
-                "start_frame": i["frame_number"],
-                "x": int(i["x"]) if "x" in i else None,
-                "y": int(i["y"]) if "y" in i else None,
-                "w": int(i["width"]) if "width" in i else None,
-                "h": int(i["height"]) if "height" in i else None,
-                "subject_id": int(i["subject_id"]) if "subject_id" in i else None,
-            }
-        )
-        for i in w2_data.annotation.explode()
-        if i is not None and i is not np.nan
-    ]
-
-    # Get prepared annotations
-    w2_full = pd.DataFrame(ds)
-    w2_annotations = w2_full[w2_full["x"].notnull()]
-
-    new_rows = []
-    final_indices = []
-    for name, group in w2_annotations.groupby(["movie_id", "label", "start_frame"]):
-        movie_id, label, start_frame = name
-
-        total_users = w2_full[
-            (w2_full.movie_id == movie_id)
-            & (w2_full.label == label)
-            & (w2_full.start_frame == start_frame)
-        ]["user"].nunique()
-
-        # Filter bboxes using IOU metric (essentially a consensus metric)
-        # Keep only bboxes where mean overlap exceeds this threshold
-        indices, new_group = filter_bboxes(
-            total_users=total_users,
-            users=[i[0] for i in group.values],
-            bboxes=[np.array((i[4], i[5], i[6], i[7])) for i in group.values],
-            obj=object_thresh,
-            eps=iou_epsilon,
-            iua=inter_user_agreement,
-        )
-
-        subject_ids = [i[8] for i in group.values[indices]]
-
-        for ix, box in zip(subject_ids, new_group):
-            new_rows.append(
-                (
-                    movie_id,
-                    label,
-                    start_frame,
-                    ix,
-                )
-                + tuple(box)
-            )
-
-    w2_annotations = pd.DataFrame(
-        new_rows,
-        columns=[
-            "movie_id",
-            "label",
-            "start_frame",
-            "subject_ids",
-            "x",
-            "y",
-            "w",
-            "h",
-        ],
-    )
+    # Reach a consensus on the boxes drawn on each frame
+    w2_annotations = aggregate_frame_boxes(
+        w2_full, object_thresh, iou_epsilon, inter_user_agreement
+    ).rename(columns={"subject_id": "subject_ids"})
 
     # Filter out invalid movies
     w2_annotations = w2_annotations[w2_annotations["movie_id"].notnull()][
@@ -1,12 +1,19 @@
 import argparse, os, cv2, re, ast
 import utils.db_utils as db_utils
+from utils import profile_utils, movie_utils
 import pandas as pd
 import numpy as np
-import math, subprocess
+import math, random, subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from datetime import date
-from utils.zooniverse_utils import auth_session
+from utils.zooniverse_utils import (
+    auth_session,
+    get_subject_set,
+    upload_subjects,
+    close_manifest,
+)
 from panoptes_client import (
     SubjectSet,
     Subject,
@@ -14,6 +21,23 @@ from panoptes_client import (
     Panoptes,
 )
 
+# Maximum size in bytes of the clips uploaded (Zooniverse constraint)
+MAX_CLIP_SIZE = 2000000
+
+# Share of the size budget aimed at, leaving room for the container and rate control
+SIZE_MARGIN = 0.9
+
+# Bitrate of the audio of the clips re-encoded, in kbit/s
+AUDIO_KBPS = 64
+
+# Number of encodes tried for a clip before giving up on fitting it
+MAX_ENCODE_ATTEMPTS = 3
+
+# Seconds between two clips of a movie beyond which seeking to the next clip
+# is cheaper than decoding up to it, starting a new ffmpeg pass
+MAX_PASS_GAP = 60
+
+
 def arg_as_list(s):                                                            
     v = ast.literal_eval(s)                                                    
     if type(v) is not list:                                                    
@@ -21,25 +45,113 @@ def arg_as_list(s):
     return v
 
 
-def expand_list(df, list_column, new_column):
-    lens_of_lists = df[list_column].apply(len)
-    origin_rows = range(df.shape[0])
-    destination_rows = np.repeat(origin_rows, lens_of_lists)
-    non_list_cols = [idx for idx, col in enumerate(df.columns) if col != list_column]
-    expanded_df = df.iloc[destination_rows, non_list_cols].copy()
-    expanded_df[new_column] = [item for items in df[list_column] for item in items]
-    expanded_df.reset_index(inplace=True, drop=True)
-    return expanded_df
+# Function to merge overlapping or touching [start, end] intervals of integers
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if len(merged) > 0 and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
 
 
-def get_clips(n_clips, clip_length, conn, video_list, num_each):
+# Function to get the ranges of clip slots of a movie that are still free.
+# Slot k is the clip starting at second k * clip_length
+def free_slots(n_slots, blocked_seconds, clip_length):
+
+    # Convert the blocked seconds to the slots starting within them
+    blocked_slots = [
+        (max(-(-start // clip_length), 0), min(end // clip_length, n_slots - 1))
+        for start, end in blocked_seconds
+    ]
+    blocked_slots = merge_intervals([i for i in blocked_slots if i[0] <= i[1]])
+
+    # Take the complement of the blocked slots
+    free, first = [], 0
+    for start, end in blocked_slots:
+        if start > first:
+            free.append((first, start - 1))
+        first = end + 1
+    if first < n_slots:
+        free.append((first, n_slots - 1))
+
+    return free
+
+
+# Function to draw n different start seconds from the free slots of a movie
+def sample_slots(free, n, clip_length):
+
+    # Count the free slots up to the end of each range
+    counts = np.cumsum([end - start + 1 for start, end in free])
+    total = int(counts[-1]) if len(counts) > 0 else 0
+
+    # Draw the ranks of the slots and find the range of each
+    ranks = np.array(random.sample(range(total), n), dtype=np.int64)
+    ranges = np.searchsorted(counts, ranks, side="right")
+    offsets = ranks - np.concatenate([[0], counts])[ranges]
+    firsts = np.array([start for start, end in free], dtype=np.int64)
+
+    return (firsts[ranges] + offsets) * clip_length
+
+
+# Function to remove some slots from the free ranges of a movie
+def remove_slots(free, slots):
+    slots = np.sort(np.asarray(slots, dtype=np.int64))
+    remaining = []
+    for start, end in free:
+        first, last = np.searchsorted(slots, [start, end + 1])
+        for slot in slots[first:last]:
+            if slot > start:
+                remaining.append((start, int(slot) - 1))
+            start = int(slot) + 1
+        if start <= end:
+            remaining.append((start, end))
+    return remaining
+
+
+# Function to get the free slots of a movie whose start second is a keyframe,
+# so that their clips can be cut without re-encoding
+def keyframe_slots(keyframes, free, clip_length, fps):
+
+    if keyframes is None or len(keyframes) == 0 or len(free) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=float)
+
+    # Select the keyframes within half a frame of the start of a slot
+    tolerance = 0.5 / fps if fps and fps > 0 else 0.02
+    slots = np.round(keyframes / clip_length).astype(np.int64)
+    aligned = np.abs(keyframes - slots * clip_length) <= tolerance
+    slots, times = slots[aligned], keyframes[aligned]
+    slots, first = np.unique(slots, return_index=True)
+    times = times[first]
+
+    # Keep the slots within the free ranges
+    starts = np.array([start for start, end in free], dtype=np.int64)
+    ends = np.array([end for start, end in free], dtype=np.int64)
+    ranges = np.searchsorted(starts, slots, side="right") - 1
+    free_slot = (ranges >= 0) & (slots <= ends[np.maximum(ranges, 0)])
+
+    return slots[free_slot], times[free_slot]
+
+
+def get_clips(
+    n_clips,
+    clip_length,
+    conn,
+    video_list,
+    num_each,
+    prefer_keyframes=True,
+    max_size=MAX_CLIP_SIZE,
+):
 
     # Get information of the movies to upload new clips from
-    if len(video_list) > 0:
+    if video_list is not None and len(video_list) > 0:
         # Select only the movies of interest if specified
+        video_list = [int(i) for i in video_list]
         available_movies_df = pd.read_sql_query(
-            f"SELECT id, fps, duration, fpath FROM movies WHERE id IN {tuple([int(i) for i in video_list])}",
+            f"SELECT id, fps, duration, fpath FROM movies WHERE id IN ({','.join('?' * len(video_list))})",
             conn,
+            params=video_list,
         )
     else:
         # Select all movies
@@ -51,89 +163,307 @@ def get_clips(n_clips, clip_length, conn, video_list, num_each):
     # Rename the id of the movies to avoid confusion
     available_movies_df = available_movies_df.rename(columns={"id": "movie_id"})
 
-    # Set the start of each movie of interest
-    available_movies_df["start"] = 0
-
     # Convert the "duration" column to integer
     available_movies_df["duration"] = available_movies_df["duration"].astype(int)
 
-    # Calculate all the potential seconds for the new clips to start
-    available_movies_df["seconds"] = [
-        list(range(i, int(math.floor(j / clip_length) * clip_length), clip_length))
-        for i, j in available_movies_df[["start", "duration"]].values
-    ]
-
-    # Reshape the dataframe of potential seconds for the new clips to start
-    potential_start_df = expand_list(available_movies_df, "seconds", "pot_seconds")
-
     # Get information of clips uploaded
     uploaded_clips_df = pd.read_sql_query(
-        f"SELECT movie_id, clip_start_time, clip_end_time FROM subjects WHERE subject_type='clip' AND movie_id IN {tuple(available_movies_df['movie_id'].values)}",
+        f"SELECT movie_id, clip_start_time, clip_end_time FROM subjects WHERE subject_type='clip'",
         conn,
     )
+    uploaded_clips_df = uploaded_clips_df[
+        uploaded_clips_df["movie_id"].isin(available_movies_df["movie_id"])
+    ]
 
-    # Calculate the time when the new clips shouldn't start to avoid duplication (min=0)
+    # Calculate the seconds when the new clips shouldn't start to avoid duplication (min=0)
     uploaded_clips_df["clip_start_time"] = (
         uploaded_clips_df["clip_start_time"] - clip_length
     ).clip(lower=0)
-
-    # Calculate all the seconds when the new clips shouldn't start
-    uploaded_clips_df["seconds"] = [
-        list(range(i, j + 1))
-        for i, j in uploaded_clips_df[["clip_start_time", "clip_end_time"]].values
+    blocked_dict = {
+        movie_id: group[["clip_start_time", "clip_end_time"]].astype(int).values.tolist()
+        for movie_id, group in uploaded_clips_df.groupby("movie_id")
+    }
+
+    # Calculate the ranges of potential starts of new clips in each movie,
+    # keeping only the movies with at least one potential start
+    available_movies_df["free"] = [
+        free_slots(duration // clip_length, blocked_dict.get(movie_id, []), clip_length)
+        for movie_id, duration in available_movies_df[["movie_id", "duration"]].values
     ]
-
-    # Reshape the dataframe of the seconds when the new clips shouldn't start
-    uploaded_start = expand_list(uploaded_clips_df, "seconds", "upl_seconds")[
-        ["movie_id", "upl_seconds"]
-    ]
-
-    # Exclude starting times of clips that have already been uploaded
-    potential_clips_df = (
-        pd.merge(
-            potential_start_df,
-            uploaded_start,
-            how="left",
-            left_on=["movie_id", "pot_seconds"],
-            right_on=["movie_id", "upl_seconds"],
-            indicator=True,
-        )
-        .query('_merge == "left_only"')
-        .drop(columns=["_merge"])
+    available_movies_df["n_free"] = available_movies_df["free"].apply(
+        lambda x: sum(end - start + 1 for start, end in x)
     )
+    available_movies_df = available_movies_df[
+        available_movies_df["n_free"] > 0
+    ].drop_duplicates(subset=["movie_id"])
 
     # Sample up to n clips
-    new_clips_df = potential_clips_df.drop_duplicates(subset=["fpath", "pot_seconds"])
-
     if len(num_each) > 0:
-        sample_df = pd.DataFrame()
-        for i, name in enumerate(potential_clips_df.movie_id.unique()):
-            sample_df = pd.concat(
-                [
-                    sample_df,
-                    new_clips_df[new_clips_df["movie_id"] == name].sample(
-                        n=int(num_each[i])
-                    ),
-                ]
-            )
-        new_clips_df = sample_df
+        # Sample the number of clips specified for each movie
+        n_samples = [int(i) for i in num_each[: len(available_movies_df)]]
+        n_samples += [0] * (len(available_movies_df) - len(n_samples))
     else:
-        new_clips_df = potential_clips_df.sample(n=n_clips)
+        # Split the n clips among the movies as if sampling from all their free slots
+        ranks = np.array(
+            random.sample(range(int(available_movies_df["n_free"].sum())), n_clips),
+            dtype=np.int64,
+        )
+        n_samples = np.bincount(
+            np.searchsorted(
+                np.cumsum(available_movies_df["n_free"].values), ranks, side="right"
+            ),
+            minlength=len(available_movies_df),
+        )
+
+    # Get the average bytes per second of the movies sampled. Copying a clip
+    # keeps the bitrate of its movie, so only the movies whose clips can fit
+    # the maximum size without re-encoding benefit from starting on a keyframe
+    n_samples = np.asarray(n_samples, dtype=np.int64)
+    byte_rates = np.full(len(available_movies_df), np.nan)
+    copyable = np.zeros(len(available_movies_df), dtype=bool)
+    if prefer_keyframes and (n_samples > 0).any():
+        sampled = np.flatnonzero(n_samples > 0)
+        byte_rates[sampled] = movie_utils.get_byte_rates(
+            available_movies_df["fpath"].values[sampled],
+            available_movies_df["duration"].values[sampled],
+            conn,
+        )
+        copyable[sampled] = ~(byte_rates[sampled] * clip_length > (max_size or np.inf))
+
+    # Get the keyframes of the movies whose clips may be copied, indexed once per movie
+    keyframes = [None] * len(available_movies_df)
+    if copyable.any():
+        to_index = np.flatnonzero(copyable)
+        for i, movie_keyframes in zip(
+            to_index,
+            movie_utils.get_keyframes(
+                available_movies_df["fpath"].values[to_index], conn
+            ),
+        ):
+            keyframes[i] = movie_keyframes
+
+    # Draw the start seconds of the clips of each movie, preferring the
+    # slots that start on a keyframe
+    clips = []
+    for (_, movie), n, movie_keyframes, byte_rate in zip(
+        available_movies_df.iterrows(), n_samples, keyframes, byte_rates
+    ):
+        slots, times = keyframe_slots(
+            movie_keyframes, movie["free"], clip_length, movie["fps"]
+        )
+        chosen = random.sample(range(len(slots)), min(int(n), len(slots)))
+        for i in chosen:
+            clips.append(
+                (
+                    movie["movie_id"],
+                    movie["fps"],
+                    movie["fpath"],
+                    int(slots[i]) * clip_length,
+                    times[i],
+                    byte_rate,
+                )
+            )
+
+        # Draw the rest of the clips from the slots that do not start on a keyframe
+        free = remove_slots(movie["free"], slots)
+        for second in sample_slots(free, int(n) - len(chosen), clip_length):
+            clips.append(
+                (
+                    movie["movie_id"],
+                    movie["fps"],
+                    movie["fpath"],
+                    int(second),
+                    np.nan,
+                    byte_rate,
+                )
+            )
 
     # Select only relevant columns
-    clips_df = new_clips_df[["movie_id", "fps", "fpath", "pot_seconds"]]
+    clips_df = pd.DataFrame(
+        clips,
+        columns=[
+            "movie_id",
+            "fps",
+            "fpath",
+            "pot_seconds",
+            "keyframe_time",
+            "byte_rate",
+        ],
+    )
 
     return clips_df
 
 
+# Function to check if a clip was extracted
+def is_extracted(clip_path):
+    return os.path.isfile(clip_path) and os.path.getsize(clip_path) > 0
+
+
+# Function to get the size of a clip, 0 if it was not extracted
+def clip_size(clip_path):
+    return os.path.getsize(clip_path) if os.path.isfile(clip_path) else 0
+
+
+# Function to get the video bitrate (kbit/s) that fits a clip in the maximum size
+def video_bitrate(clip_length, max_size, margin=SIZE_MARGIN):
+    total_kbps = max_size * 8 / 1000 / clip_length * margin
+    return max(int(total_kbps - AUDIO_KBPS), 1)
+
+
+# Function to get the ffmpeg options encoding a clip at a video bitrate in one pass
+def encode_options(video_kbps):
+    if video_kbps is None:
+        return []
+    return [
+        "-c:v",
+        "libx264",
+        "-b:v",
+        f"{video_kbps}k",
+        "-maxrate",
+        f"{video_kbps}k",
+        "-bufsize",
+        f"{2 * video_kbps}k",
+        "-c:a",
+        "aac",
+        "-b:a",
+        f"{AUDIO_KBPS}k",
+    ]
+
+
+# Function to group the clips of a movie, sorted by start time, into ffmpeg passes
+# of nearby clips, so that a pass never decodes long stretches between its clips
+def group_passes(clips, clip_length, clips_per_pass, max_gap=MAX_PASS_GAP):
+    passes = []
+    for start_time, clip_path in clips:
+        if (
+            len(passes) == 0
+            or len(passes[-1]) >= clips_per_pass
+            or start_time - passes[-1][-1][0] - clip_length > max_gap
+        ):
+            passes.append([])
+        passes[-1].append((start_time, clip_path))
+    return passes
+
+
+# Function to extract several clips of a movie. Clips starting on a keyframe
+# are copied without decoding, the rest are cut with one ffmpeg process per
+# pass of nearby clips, seeking to the first clip of the pass and trimming
+# each clip as a separate output
+def extract_movie_clips(
+    movie,
+    start_times,
+    clip_paths,
+    clip_length,
+    clips_per_pass,
+    keyframe_times=None,
+    max_size=None,
+    byte_rate=None,
+):
+    if keyframe_times is None:
+        keyframe_times = [np.nan] * len(clip_paths)
+
+    # Encode the clips at the bitrate that fits them in the maximum size
+    video_kbps = video_bitrate(clip_length, max_size) if max_size else None
+
+    # Skip copying the clips when the bitrate of the movie cannot fit them
+    if max_size and byte_rate is not None and byte_rate * clip_length > max_size:
+        keyframe_times = [np.nan] * len(clip_paths)
+
+    # Copy the packets of the clips that start on a keyframe. Seeking just
+    # after the keyframe makes ffmpeg start the copy on it
+    to_encode = []
+    for start_time, clip_path, keyframe_time in zip(
+        start_times, clip_paths, keyframe_times
+    ):
+        if not np.isnan(keyframe_time):
+            returncode = subprocess.call(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-ss",
+                    f"{keyframe_time + 0.001:.3f}",
+                    "-i",
+                    movie,
+                    "-t",
+                    str(clip_length),
+                    "-c",
+                    "copy",
+                    "-avoid_negative_ts",
+                    "make_zero",
+                    str(clip_path),
+                ]
+            )
+            if returncode == 0 and is_extracted(clip_path):
+                if not max_size or clip_size(clip_path) <= max_size:
+                    continue
+
+        # Re-encode the clips that are not aligned, could not be copied or are too large
+        to_encode.append((start_time, clip_path))
+
+    # Cut the clips in the order they appear in the movie
+    clips = sorted(to_encode)
+
+    for clips_pass in group_passes(clips, clip_length, clips_per_pass):
+        # Seek to the first clip of the pass, the outputs start relative to it
+        pass_start = clips_pass[0][0]
+        command = ["ffmpeg", "-y", "-ss", str(pass_start), "-i", movie]
+        for start_time, clip_path in clips_pass:
+            command += [
+                "-ss",
+                str(start_time - pass_start),
+                "-t",
+                str(clip_length),
+                "-force_key_frames",
+                "1",
+            ]
+            command += encode_options(video_kbps) + [str(clip_path)]
+        subprocess.call(command)
+
+    # Re-encode the rare clips that overshoot the maximum size, one at a time,
+    # lowering the bitrate by how much they overshot
+    attempts = {clip_path: 1 for start_time, clip_path in to_encode}
+    for start_time, clip_path in clips if max_size else []:
+        kbps = video_kbps
+        while (
+            clip_size(clip_path) > max_size
+            and attempts[clip_path] < MAX_ENCODE_ATTEMPTS
+        ):
+            kbps = max(int(kbps * max_size / clip_size(clip_path) * SIZE_MARGIN), 1)
+            subprocess.call(
+                ["ffmpeg", "-y", "-ss", str(start_time), "-i", movie]
+                + ["-t", str(clip_length), "-force_key_frames", "1"]
+                + encode_options(kbps)
+                + [str(clip_path)]
+            )
+            attempts[clip_path] += 1
+
+    # Check which clips were extracted, which of them were copied,
+    # their size and the number of times they were encoded
+    return [
+        (
+            is_extracted(clip_path),
+            clip_path not in attempts,
+            clip_size(clip_path),
+            attempts.get(clip_path, 0),
+        )
+        for clip_path in clip_paths
+    ]
+
+
 # Function to extract the clips
-def extract_clips(df, clips_folder, clip_length):
+@profile_utils.timed("encode")
+def extract_clips(
+    df,
+    clips_folder,
+    clip_length,
+    n_workers=1,
+    clips_per_pass=20,
+    max_size=MAX_CLIP_SIZE,
+):
 
     # Get movies filenames from their path
     df["movie_filename"] = df["fpath"].str.split("/").str[-1].str.replace(".mp4", "")
 
-    print(df.movie_filename)
-
     # Set the filename of the clips
     df["clip_path"] = (
         clips_folder
@@ -146,28 +476,53 @@ def extract_clips(df, clips_folder, clip_length):
         + ".mp4"
     )
 
-    # Read each movie and extract the clips
-    for movie in df.fpath.unique():
-        movie_df = df[df["fpath"] == movie]
-        for i in range(len(movie_df.index)):
-            subprocess.call(
-                [
-                    "ffmpeg",
-                    "-ss",
-                    str(movie_df.iloc[i]["pot_seconds"]),
-                    "-i",
-                    movie,
-                    "-t",
-                    str(clip_length),
-                    # "-c",
-                    # "copy",
-                    "-force_key_frames",
-                    "1",
-                    str(movie_df.iloc[i]["clip_path"]),
-                ]
-            )
-
-    print("clips extracted successfully")
+    # Clips are not extracted until their movie is processed, so the clips of
+    # movies without a path are reported as failed
+    df["extracted"], df["copied"], df["size"], df["attempts"] = False, False, 0, 0
+
+    # Group the clips to extract by movie
+    movie_groups = list(df.groupby("fpath"))
+
+    # Keep the encoders running at the same time within the number of CPUs,
+    # as each movie may encode up to clips_per_pass clips at once
+    if len(movie_groups) > 0:
+        encoders = min(clips_per_pass, max(len(group) for _, group in movie_groups))
+        n_workers = min(n_workers, (os.cpu_count() or 1) // encoders)
+
+    # Extract the clips of several movies at the same time
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        results = executor.map(
+            lambda x: extract_movie_clips(
+                x[0],
+                x[1]["pot_seconds"].values,
+                x[1]["clip_path"].values,
+                clip_length,
+                clips_per_pass,
+                x[1]["keyframe_time"].values if "keyframe_time" in x[1] else None,
+                max_size,
+                x[1]["byte_rate"].iloc[0] if "byte_rate" in x[1] else None,
+            ),
+            movie_groups,
+        )
+        for (movie, group), movie_results in zip(movie_groups, results):
+            extracted, copied, sizes, attempts = zip(*movie_results)
+            df.loc[group.index, "extracted"] = extracted
+            df.loc[group.index, "copied"] = copied
+            df.loc[group.index, "size"] = sizes
+            df.loc[group.index, "attempts"] = attempts
+
+    # Get the average bitrate of the clips
+    df["bitrate_kbps"] = df["size"] * 8 / 1000 / clip_length
+
+    # Report the clips that could not be extracted
+    failed_clips = df[~df["extracted"].astype(bool)]["clip_path"]
+    for clip_path in failed_clips:
+        print(f"Failed to extract {clip_path}")
+
+    print(f"{len(df) - len(failed_clips)} out of {len(df)} clips extracted successfully")
+    print(
+        f"{int((df['extracted'].astype(bool) & df['copied'].astype(bool)).sum())} clips copied without re-encoding"
+    )
     return df["clip_path"]
 
 
@@ -227,9 +582,53 @@ def main():
         required=False,
         default=[],
     )
+    parser.add_argument(
+        "-nw",
+        "--n_workers",
+        type=int,
+        help="number of movies to extract clips from in parallel, capped so that the clips encoded at once do not exceed the CPUs",
+        default=os.cpu_count(),
+        required=False,
+    )
+    parser.add_argument(
+        "-cpp",
+        "--clips_per_pass",
+        type=int,
+        help="maximum number of clips cut by one ffmpeg process",
+        default=20,
+        required=False,
+    )
+
+    parser.add_argument(
+        "-ms",
+        "--max_clip_size",
+        type=int,
+        help="maximum size in bytes of the clips, whose bitrate is set to fit it (0 to keep the default encoding)",
+        default=MAX_CLIP_SIZE,
+        required=False,
+    )
+    parser.add_argument(
+        "--no_keyframes",
+        help="sample clip starts without preferring keyframes, re-encoding every clip",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "-uw",
+        "--upload_workers",
+        type=int,
+        help="number of subjects uploaded to Zooniverse at the same time",
+        default=8,
+        required=False,
+    )
+
+    profile_utils.add_arguments(parser)
 
     args = parser.parse_args()
 
+    # Measure the stages of the run if asked to
+    profile_utils.setup(args)
+
     # Set the clip of the length if specified
     if args.clip_length:
         clip_length = args.clip_length
@@ -237,20 +636,81 @@ def main():
     # Connect to koster_db
     conn = db_utils.create_connection(args.db_path)
 
+    # The keyframes, probes and clip audits need the migrations up to version 5
+    db_utils.check_schema(conn, 5)
+
     # Connect to Zooniverse
     koster_project = auth_session(args.user, args.password)
 
     # Identify n number of clips that haven't been uploaded to Zooniverse
     clips_df = get_clips(
-        args.n_clips, args.clip_length, conn, args.video_list, args.num_each
+        args.n_clips,
+        args.clip_length,
+        conn,
+        args.video_list,
+        args.num_each,
+        prefer_keyframes=not args.no_keyframes,
+        max_size=args.max_clip_size,
     )
 
+    if len(clips_df) == 0:
+        print("There are no new clips to extract from the movies selected")
+        return
+
     # Create the folder to store the clips if not exist
     if not os.path.exists(args.clips_folder):
         os.mkdir(args.clips_folder)
 
     # Extract the clips and store them in the folder
-    clips_df["clip_path"] = extract_clips(clips_df, args.clips_folder, args.clip_length)
+    clips_df["clip_path"] = extract_clips(
+        clips_df,
+        args.clips_folder,
+        args.clip_length,
+        args.n_workers,
+        args.clips_per_pass,
+        args.max_clip_size,
+    )
+
+    # Record the size and bitrate of the clips extracted
+    db_utils.upsert_many(
+        conn,
+        [
+            (
+                clip_path,
+                int(movie_id),
+                int(start_time),
+                int(args.clip_length),
+                int(size),
+                float(bitrate),
+                int(copied),
+                int(attempts),
+                date.today().isoformat(),
+            )
+            for clip_path, movie_id, start_time, size, bitrate, copied, attempts in clips_df[
+                [
+                    "clip_path",
+                    "movie_id",
+                    "pot_seconds",
+                    "size",
+                    "bitrate_kbps",
+                    "copied",
+                    "attempts",
+                ]
+            ].values
+        ],
+        "clip_encodes",
+    )
+
+    # Upload only the clips that were extracted
+    clips_df = clips_df[clips_df["extracted"].astype(bool)]
+
+    # File size check (Zooniverse constraint), leaving out the clips that still do not fit
+    too_large = clips_df["size"] > (args.max_clip_size or np.inf)
+    if too_large.any():
+        print(
+            f"{too_large.sum()} clips are larger than {args.max_clip_size} bytes and will not be uploaded, please shorten your clip length"
+        )
+        clips_df = clips_df[~too_large]
 
     # Select koster db metadata associated with each clip
     clips_df["clip_start_time"] = clips_df["pot_seconds"]
@@ -274,35 +734,23 @@ def main():
     # Save the df as the subject metadata
     subject_metadata = clips_df.set_index("clip_path").to_dict("index")
 
-    # File size check (Zooniverse constraint)
-    assert sum(clips_df["filename"].apply(lambda x: Path(x).stat().st_size, 1) <= 2000000) == len(clips_df), "Some of your clips are larger than 2MB and may fail to upload, please shorten your clip length"
-
-    # Create a subjet set in Zooniverse to host the frames
-    subject_set = SubjectSet()
-
-    subject_set.links.project = koster_project
-    subject_set.display_name = "clips" + date.today().strftime("_%d_%b_%Y")
-
-    subject_set.save()
+    # Keep track of the upload to resume it if interrupted
+    manifest_path = os.path.join(args.clips_folder, "upload_manifest.jsonl")
 
-    print("Zooniverse subject set created")
-
-    # Upload frames to Zooniverse (with metadata)
-    new_subjects = []
-
-    for filename, metadata in subject_metadata.items():
-        subject = Subject()
-
-        subject.links.project = koster_project
-        subject.add_location(filename)
-
-        subject.metadata.update(metadata)
-
-        subject.save()
-        new_subjects.append(subject)
+    # Create a subjet set in Zooniverse to host the clips
+    subject_set = get_subject_set(
+        koster_project, "clips" + date.today().strftime("_%d_%b_%Y"), manifest_path
+    )
 
-    # Upload frames
-    subject_set.add(new_subjects)
+    # Upload clips to Zooniverse (with metadata)
+    upload_subjects(
+        koster_project,
+        subject_set,
+        subject_metadata,
+        manifest_path,
+        n_workers=args.upload_workers,
+    )
+    close_manifest(manifest_path)
 
     print("Subjects uploaded to Zooniverse")
 
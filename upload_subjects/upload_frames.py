@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
 import argparse, os, cv2, re
 import utils.db_utils as db_utils
+from utils import profile_utils, resolver_utils, frame_store_utils
 import pandas as pd
 import numpy as np
-import pims
 
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 from datetime import date
-from utils.zooniverse_utils import auth_session
+from utils.video_utils import FrameFetcher
+from utils.frame_store_utils import FrameStore
+from utils.movie_utils import resolve_movie_paths, resolve_path
+from utils.zooniverse_utils import (
+    auth_session,
+    get_subject_set,
+    upload_subjects,
+    close_manifest,
+)
 from panoptes_client import (
     SubjectSet,
     Subject,
@@ -16,63 +25,72 @@ from panoptes_client import (
 )
 
 
-def unswedify(string):
-    """Convert ä and ö to utf-8"""
-    return (
-        string.encode("utf-8")
-        .replace(b"\xc3\xa4", b"a\xcc\x88")
-        .replace(b"\xc3\xb6", b"o\xcc\x88")
-        .decode("utf-8")
-    )
+# Frames of n seconds after the first time each species was seen in each clip,
+# leaving out the frames already uploaded for that species
+CANDIDATE_FRAMES_SQL = """
+WITH RECURSIVE offsets(j) AS (
+    SELECT 0 WHERE 0 < :n_frames
+    UNION ALL SELECT j + 1 FROM offsets WHERE j + 1 < :n_frames
+),
+candidates AS (
+    SELECT
+        a.species_id AS frame_exp_sp_id,
+        sp.label AS label,
+        c.movie_id AS movie_id,
+        c.clip_start_time AS clip_start_time,
+        a.first_seen AS first_seen,
+        c.clip_start_time + a.first_seen AS first_seen_movie,
+        m.fpath AS fpath,
+        COALESCE(m.fps, 25.0) AS fps,
+        CAST(
+            (c.clip_start_time + a.first_seen + o.j) * COALESCE(m.fps, 25.0) AS integer
+        ) AS frame_number
+    FROM agg_annotations_clip AS a
+    JOIN temp.candidate_species AS s ON s.id = a.species_id
+    JOIN species AS sp ON sp.id = a.species_id
+    JOIN subjects AS c ON c.id = a.subject_id AND c.subject_type = 'clip'
+    JOIN movies AS m ON m.id = c.movie_id
+    CROSS JOIN offsets AS o
+)
+SELECT * FROM candidates AS f
+WHERE :exclude_uploaded = 0 OR NOT EXISTS (
+    SELECT 1 FROM subjects AS u
+    WHERE u.movie_id = f.movie_id
+    AND u.frame_number = f.frame_number
+    AND u.frame_exp_sp_id = f.frame_exp_sp_id
+)
+"""
 
 
 # Function to identify up to n number of frames per classified clip
-# that contains species of interest after the first time seen
-def get_species_frames(species_id, conn, n_frames):
+# that contains the species of interest after the first time seen
+def get_candidate_frames(
+    conn, species_ids, n_frames, movies_paths=None, exclude_uploaded=True
+):
 
-    # Find classified clips that contain the species of interest
+    # Stage the species of interest for the query
+    db_utils.create_temp_ids(conn, "candidate_species", species_ids)
+
+    # Get the frames of the classified clips that contain the species of interest
+    # TODO: Fix fps figures for old movies, missing fps are taken as 25
     frames_df = pd.read_sql_query(
-        f"SELECT subject_id, first_seen FROM agg_annotations_clip WHERE agg_annotations_clip.species_id={species_id}",
+        CANDIDATE_FRAMES_SQL,
         conn,
+        params={"n_frames": int(n_frames), "exclude_uploaded": int(exclude_uploaded)},
     )
 
-    # Add species id to the df
-    frames_df["frame_exp_sp_id"] = species_id
-
-    # Get start time of the clips and ids of the original movies
-    (frames_df["clip_start_time"], frames_df["movie_id"],) = list(
-        zip(
-            *pd.read_sql_query(
-                f"SELECT clip_start_time, movie_id FROM subjects WHERE id IN {tuple(frames_df['subject_id'].values)} AND subject_type='clip'",
-                conn,
-            ).values
-        )
-    )
-
-    # Identify the second of the original movie when the species first appears
-    frames_df["first_seen_movie"] = (
-        frames_df["clip_start_time"] + frames_df["first_seen"]
-    )
-
-    # Get the filepath and fps of the original movies
-    f_paths = pd.read_sql_query(f"SELECT id, fpath, fps FROM movies", conn)
-
-    # TODO: Fix fps figures for old movies and paths. Right now the path configuration is done manually to fix old copies
-    f_paths["fps"] = f_paths["fps"].apply(lambda x: 25.0 if np.isnan(x) else x, 1)
-    extensions = f_paths["fpath"].apply(lambda x: '' if len(os.path.splitext(x))>1 and os.path.splitext(x)[1]!='' else '.mov', 1)
-    f_paths["fpath"] = f_paths["fpath"].apply(lambda x: os.path.basename(x), 1)
-    f_paths["fpath"] = "/cephyr/NOBACKUP/groups/snic2021-6-9/movies/" + f_paths["fpath"] + extensions
-
-    # Ensure swedish characters don't cause issues
-    f_paths["fpath"] = f_paths["fpath"].apply(
-        lambda x: str(x) if os.path.isfile(str(x)) else unswedify(str(x))
-    )
-    # Include movies' filepath and fps to the df
-    frames_df = frames_df.merge(f_paths, left_on="movie_id", right_on="id")
+    # Find the movies in the movie library, whatever their extension and unicode form,
+    # or at the path stored in the movies table if no library is given
+    movie_paths = frames_df["fpath"].drop_duplicates()
+    if movies_paths is not None:
+        resolved = resolve_movie_paths(movie_paths, movies_paths).values
+    else:
+        resolved = [resolve_path(str(i)) for i in movie_paths]
+    movie_paths = pd.Series(resolved, index=movie_paths.values, dtype=object)
+    frames_df["fpath"] = frames_df["fpath"].map(movie_paths)
 
     # Specify if original movies can be found
-    # frames_df["fpath"] = frames_df["fpath"].apply(lambda x: x.encode('utf-8'))
-    frames_df["exists"] = frames_df["fpath"].map(os.path.isfile)
+    frames_df["exists"] = frames_df["fpath"].notnull()
 
     if len(frames_df[~frames_df.exists]) > 0:
         print(
@@ -80,36 +98,65 @@ def get_species_frames(species_id, conn, n_frames):
         )
 
     # Select only frames from movies that can be found
-    frames_df = frames_df[frames_df.exists]
-
-    # Identify the ordinal number of the frames expected to be extracted
-    frames_df["frame_number"] = frames_df[["first_seen_movie", "fps"]].apply(
-        lambda x: [
-            int((x["first_seen_movie"] + j) * x["fps"]) for j in range(n_frames)
-        ],
-        1,
+    frames_df = frames_df[frames_df.exists].reset_index(drop=True)
+
+    return frames_df
+
+
+# Function to identify up to n number of frames per classified clip
+# that contains species of interest after the first time seen
+def get_species_frames(species_id, conn, n_frames, movies_paths=None):
+    return get_candidate_frames(
+        conn, [species_id], n_frames, movies_paths, exclude_uploaded=False
     )
 
-    # Reshape df to have each frame as rows
-    lst_col = "frame_number"
 
-    frames_df = pd.DataFrame(
-        {
-            col: np.repeat(frames_df[col].values, frames_df[lst_col].str.len())
-            for col in frames_df.columns.difference([lst_col])
-        }
-    ).assign(**{lst_col: np.concatenate(frames_df[lst_col].values)})[
-        frames_df.columns.tolist()
-    ]
+# Function to extract and save the frames of a single movie
+def extract_movie_frames(movie_path, frame_numbers, frame_paths, store_root=None):
 
-    # Drop unnecessary columns
-    frames_df.drop(["subject_id"], inplace=True, axis=1)
+    # Get the paths of each frame number
+    paths_dict = {}
+    for frame_number, frame_path in zip(frame_numbers, frame_paths):
+        paths_dict.setdefault(int(frame_number), []).append(frame_path)
 
-    return frames_df
+    fetcher = FrameFetcher()
+    if store_root is None:
+        # Decode the frames forward in the order they appear in the movie
+        for frame_number, frame in fetcher.iter_movie(movie_path, paths_dict):
+            for frame_path in paths_dict[frame_number]:
+                Image.fromarray(frame).save(
+                    f"{frame_path}", **frame_store_utils.ENCODE_SETTINGS
+                )
+        return fetcher.stats, {}
+
+    # Hand out the frames already in the store
+    store = FrameStore(store_root)
+    fingerprint = frame_store_utils.movie_fingerprint(movie_path)
+    missing = []
+    for frame_number, frame_paths in paths_dict.items():
+        path = store.get(fingerprint, frame_number)
+        if path is None:
+            missing.append(frame_number)
+        else:
+            store.link(path, frame_paths)
+
+    # Decode the missing frames forward and keep them in the store
+    for frame_number, frame in fetcher.iter_movie(movie_path, missing):
+        path = store.put(fingerprint, frame_number, frame)
+        store.link(path, paths_dict[frame_number])
+
+    return fetcher.stats, store.stats
 
 
 # Function to extract frames
-def extract_frames(df, frames_folder):
+@profile_utils.timed("frame_decode")
+def extract_frames(
+    df,
+    frames_folder,
+    n_workers=1,
+    store_root=frame_store_utils.FRAME_STORE_DIR,
+    store_max_mb=frame_store_utils.FRAME_STORE_MAX_MB,
+):
 
     # Get movies filenames from their path
     df["movie_filename"] = df["fpath"].str.split("/").str[-1].str.replace(".mov", "")
@@ -125,18 +172,38 @@ def extract_frames(df, frames_folder):
         + ".jpg"
     )
 
-    # Read all original movies
-    video_dict = {k: pims.Video(k) for k in df["fpath"].unique()}
-
-    # Save the frame as matrix
-    df["frames"] = df[["fpath", "frame_number"]].apply(
-        lambda x: video_dict[x["fpath"]][int(x["frame_number"])],
-        1,
-    )
+    # Group the frames to extract by movie
+    movie_jobs = [
+        (
+            movie,
+            group["frame_number"].astype(int).values,
+            group["frame_path"].values,
+            store_root,
+        )
+        for movie, group in df.groupby("fpath")
+    ]
 
-    # Extract and save frames
-    for frame, filename in zip(df["frames"], df["frame_path"]):
-        Image.fromarray(frame).save(f"{filename}")
+    # Extract and save frames, one movie per worker process
+    if n_workers > 1 and len(movie_jobs) > 1:
+        n_workers = min(n_workers, len(movie_jobs))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            movie_stats = list(executor.map(extract_movie_frames, *zip(*movie_jobs)))
+    else:
+        movie_stats = [extract_movie_frames(*job) for job in movie_jobs]
+
+    # Report the decoding cost of the extraction and the use of the frame store
+    fetcher, store = FrameFetcher(), FrameStore(store_root, store_max_mb)
+    for fetcher_stats, store_stats in movie_stats:
+        for k, v in fetcher_stats.items():
+            fetcher.stats[k] += v
+        for k, v in store_stats.items():
+            store.stats[k] += v
+    fetcher.report()
+
+    if store_root is not None:
+        # Keep the store within its size cap
+        store.evict()
+        store.report()
 
     print("Frames extracted successfully")
     return df["frame_path"]
@@ -153,7 +220,12 @@ def main():
         "--password", "-p", help="Zooniverse password", type=str, required=True
     )
     parser.add_argument(
-        "--species", "-l", help="Species to upload", type=str, required=True
+        "--species",
+        "-l",
+        help="Species to upload",
+        type=str,
+        nargs="+",
+        required=True,
     )
     parser.add_argument(
         "-db",
@@ -171,6 +243,15 @@ def main():
         default=r"./frames",
         required=True,
     )
+    parser.add_argument(
+        "-mp",
+        "--movies_path",
+        type=str,
+        nargs="+",
+        help="the absolute paths to the folders with the movie files",
+        default=[r"/cephyr/NOBACKUP/groups/snic2021-6-9/movies"],
+        required=False,
+    )
     parser.add_argument(
         "-t",
         "--testing",
@@ -186,9 +267,48 @@ def main():
         default=2,
         required=False,
     )
+    parser.add_argument(
+        "-nw",
+        "--n_workers",
+        type=int,
+        help="number of processes extracting frames in parallel",
+        default=os.cpu_count(),
+        required=False,
+    )
+
+    parser.add_argument(
+        "-uw",
+        "--upload_workers",
+        type=int,
+        help="number of subjects uploaded to Zooniverse at the same time",
+        default=8,
+        required=False,
+    )
+
+    parser.add_argument(
+        "-fs",
+        "--frame_store",
+        type=str,
+        help="folder where extracted frames are kept between runs, 'none' to disable it",
+        default=frame_store_utils.FRAME_STORE_DIR,
+        required=False,
+    )
+    parser.add_argument(
+        "-fsm",
+        "--frame_store_mb",
+        type=float,
+        help="MB the frame store may use before the least recently used frames are evicted",
+        default=frame_store_utils.FRAME_STORE_MAX_MB,
+        required=False,
+    )
+
+    profile_utils.add_arguments(parser)
 
     args = parser.parse_args()
 
+    # Measure the stages of the run if asked to
+    profile_utils.setup(args)
+
     # Connect to koster_db
     conn = db_utils.create_connection(args.db_path)
 
@@ -196,33 +316,20 @@ def main():
     koster_project = auth_session(args.user, args.password)
 
     # Get id of species of interest
-    species_id = pd.read_sql_query(
-        f'SELECT id FROM species WHERE label="{args.species}"', conn
-    ).values[0][0]
+    species_ids = resolver_utils.resolve(conn, "species", pd.Series(args.species))
+    if species_ids.isnull().any():
+        raise ValueError("Some of the species to upload are not in the species table")
 
-    # Identify n number of frames per classified clip that contains species of interest
-    sp_frames_df = get_species_frames(species_id, conn, args.n_frames)
-
-    # Get info of frames already uploaded
-    uploaded_frames_df = pd.read_sql_query(
-        f"SELECT movie_id, frame_number, frame_exp_sp_id FROM subjects WHERE frame_exp_sp_id='{species_id}' and subject_type='frame'",
+    # Identify n number of frames per classified clip that contains species of interest,
+    # excluding the frames that have already been uploaded
+    sp_frames_df = get_candidate_frames(
         conn,
+        species_ids.astype(int),
+        args.n_frames,
+        args.movies_path,
+        exclude_uploaded=not args.testing,
     )
 
-    # Filter out frames that have already been uploaded
-    if len(uploaded_frames_df) > 0 and not args.testing:
-
-        # Exclude frames that have already been uploaded
-        sp_frames_df = sp_frames_df[
-            ~(sp_frames_df["movie_id"].isin(uploaded_frames_df["movie_id"]))
-            & ~(sp_frames_df["frame_number"].isin(uploaded_frames_df["frame_number"]))
-            & ~(
-                sp_frames_df["frame_exp_sp_id"].isin(
-                    uploaded_frames_df["frame_exp_sp_id"]
-                )
-            )
-        ]
-
     # Upload frames to Zooniverse that have not been uploaded
     if len(sp_frames_df) == 0:
         print(
@@ -236,11 +343,22 @@ def main():
             os.mkdir(args.frames_folder)
 
         # Extract the frames and save them
-        sp_frames_df["frame_path"] = extract_frames(sp_frames_df, args.frames_folder)
+        sp_frames_df["frame_path"] = extract_frames(
+            sp_frames_df,
+            args.frames_folder,
+            args.n_workers,
+            store_root=None if args.frame_store.lower() == "none" else args.frame_store,
+            store_max_mb=args.frame_store_mb,
+        )
         sp_frames_df = sp_frames_df.drop_duplicates(subset=['frame_path'])
 
+        # Upload only the frames that were found in their movie
+        extracted = sp_frames_df["frame_path"].map(os.path.isfile)
+        if not extracted.all():
+            print(f"{(~extracted).sum()} frames could not be extracted and will not be uploaded")
+            sp_frames_df = sp_frames_df[extracted]
+
         # Select koster db metadata associated with each frame
-        sp_frames_df["label"] = args.species
         sp_frames_df["subject_type"] = "frame"
 
         sp_frames_df = sp_frames_df[
@@ -258,32 +376,25 @@ def main():
         # Save the df as the subject metadata
         subject_metadata = sp_frames_df.set_index("frame_path").to_dict("index")
 
-        # Create a subjet set in Zooniverse to host the frames
-        subject_set = SubjectSet()
-
-        subject_set.links.project = koster_project
-        subject_set.display_name = args.species + date.today().strftime("_%d_%m_%Y")
+        # Keep track of the upload to resume it if interrupted
+        manifest_path = os.path.join(args.frames_folder, "upload_manifest.jsonl")
 
-        subject_set.save()
-
-        print("Zooniverse subject set created")
+        # Create a subjet set in Zooniverse to host the frames
+        subject_set = get_subject_set(
+            koster_project,
+            "_".join(args.species) + date.today().strftime("_%d_%m_%Y"),
+            manifest_path,
+        )
 
         # Upload frames to Zooniverse (with metadata)
-        new_subjects = []
-
-        for filename, metadata in subject_metadata.items():
-            subject = Subject()
-
-            subject.links.project = koster_project
-            subject.add_location(filename)
-
-            subject.metadata.update(metadata)
-
-            subject.save()
-            new_subjects.append(subject)
-
-        # Upload frames
-        subject_set.add(new_subjects)
+        upload_subjects(
+            koster_project,
+            subject_set,
+            subject_metadata,
+            manifest_path,
+            n_workers=args.upload_workers,
+        )
+        close_manifest(manifest_path)
 
         print("Subjects uploaded to Zooniverse")
 
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+from ast import literal_eval
+from utils import profile_utils
+
+# Use the fastest JSON parser available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+
+# Utility functions to decode the annotations of Zooniverse classifications
+
+
+@profile_utils.timed("json_flatten")
+def decode_clip_annotations(class_df, task="T4", reset_on_other_answers=False):
+    """Flatten the species choices of clip classifications
+    :param class_df: data frame with classification_id and annotations columns
+    :param task: the species identification task of the workflow
+    :param reset_on_other_answers: blank both answers when a choice has an answer
+        that is neither FIRSTTIME nor INDIVIDUAL, as the tutorials always did
+    :return: data frame with a row per species chosen in each classification
+        and columns classification_id, label, first_seen and how_many.
+        A species missing an answer keeps the answer of the previous species
+        flattened, as the original row-by-row loop did
+    """
+    classification_ids, labels, first_seen, how_many = [], [], [], []
+    f_time, inds = None, None
+
+    for classification_id, annotations in zip(
+        class_df["classification_id"].values, class_df["annotations"].values
+    ):
+        # Select the information from the species identification task
+        for ann_i in json_loads(annotations):
+            if ann_i["task"] != task:
+                continue
+
+            # Select each species annotated and flatten the relevant answers
+            for value_i in ann_i["value"]:
+                # If choice = 'nothing here', set follow-up answers to blank
+                if value_i["choice"] == "NOTHINGHERE":
+                    f_time, inds = "", ""
+                # If choice = species, flatten follow-up answers
+                else:
+                    for k, answer in value_i["answers"].items():
+                        if "FIRSTTIME" in k:
+                            f_time = answer.replace("S", "")
+                        if "INDIVIDUAL" in k:
+                            inds = answer
+                        elif reset_on_other_answers and "FIRSTTIME" not in k:
+                            f_time, inds = None, None
+
+                classification_ids.append(classification_id)
+                labels.append(value_i["choice"])
+                first_seen.append(f_time)
+                how_many.append(inds)
+
+    # Create a data frame with annotations as rows
+    return pd.DataFrame(
+        {
+            "classification_id": np.array(
+                classification_ids, dtype=class_df["classification_id"].dtype
+            ),
+            "label": pd.Categorical(labels),
+            "first_seen": pd.to_numeric(pd.Series(first_seen, dtype=object)),
+            "how_many": pd.to_numeric(pd.Series(how_many, dtype=object)),
+        }
+    )
+
+
+def parse_annotations(annotations):
+    """Parse the annotations of a classification, which older exports
+    stored as python literals instead of JSON"""
+    try:
+        return json_loads(annotations)
+    except ValueError:
+        return literal_eval(annotations)
+
+
+@profile_utils.timed("json_flatten")
+def decode_frame_annotations(class_df):
+    """Flatten the boxes drawn on frame subjects into typed columns
+    :param class_df: data frame with user_name, subject_ids, subject_data and annotations columns
+    :return: data frame with a row per box and columns user, movie_id, label,
+        start_frame, x, y, w, h and subject_id. Users that saw the frame but
+        drew nothing get a single row with null box columns
+    """
+    n_boxes, movie_ids, frames, labels = [], [], [], []
+    xs, ys, ws, hs = [], [], [], []
+
+    for subject_data, annotations in zip(
+        class_df["subject_data"].values, class_df["annotations"].values
+    ):
+        # Get the frame of the subject
+        subject = next(iter(json_loads(subject_data).values()))
+        movie_ids.append(subject["movie_id"])
+        frames.append(subject["frame_number"])
+        labels.append(subject["label"])
+
+        # Get the boxes drawn in the first task
+        boxes = parse_annotations(annotations)[0]["value"]
+        n_boxes.append(max(len(boxes), 1))
+        if len(boxes) == 0:
+            boxes = [{}]
+
+        for box in boxes:
+            xs.append(box.get("x"))
+            ys.append(box.get("y"))
+            ws.append(box.get("width"))
+            hs.append(box.get("height"))
+
+    # Repeat the columns of each classification for each of its boxes,
+    # keeping repeated strings as categories
+    indexer = np.repeat(np.arange(len(class_df)), np.array(n_boxes, dtype=int))
+    return pd.DataFrame(
+        {
+            "user": class_df["user_name"].values.take(indexer),
+            "movie_id": np.array(movie_ids).take(indexer),
+            "label": pd.Categorical(labels).take(indexer),
+            "start_frame": np.array(frames).take(indexer),
+            # Box coordinates are truncated to whole pixels
+            "x": np.trunc(np.array(xs, dtype=float)),
+            "y": np.trunc(np.array(ys, dtype=float)),
+            "w": np.trunc(np.array(ws, dtype=float)),
+            "h": np.trunc(np.array(hs, dtype=float)),
+            "subject_id": class_df["subject_ids"].values.take(indexer),
+        }
+    )
@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+from collections import Counter
+from sklearn.cluster import DBSCAN
+from utils import profile_utils
+
+# Utility functions to reach a consensus among the bounding boxes of different users
+
+
+def bb_iou(boxA, boxB):
+    """Compute the IoU distance (1 - IoU) between two boxes in (x, y, w, h) format.
+    This is the scalar reference of iou_distance_matrix
+    """
+
+    # Compute edges
+    temp_boxA = boxA.copy()
+    temp_boxB = boxB.copy()
+    temp_boxA[2], temp_boxA[3] = (
+        temp_boxA[0] + temp_boxA[2],
+        temp_boxA[1] + temp_boxA[3],
+    )
+    temp_boxB[2], temp_boxB[3] = (
+        temp_boxB[0] + temp_boxB[2],
+        temp_boxB[1] + temp_boxB[3],
+    )
+
+    # determine the (x, y)-coordinates of the intersection rectangle
+    xA = max(temp_boxA[0], temp_boxB[0])
+    yA = max(temp_boxA[1], temp_boxB[1])
+    xB = min(temp_boxA[2], temp_boxB[2])
+    yB = min(temp_boxA[3], temp_boxB[3])
+
+    # compute the area of intersection rectangle
+    interArea = abs(max((xB - xA, 0)) * max((yB - yA), 0))
+    if interArea == 0:
+        return 1
+    # compute the area of both the prediction and ground-truth
+    # rectangles
+    boxAArea = abs((temp_boxA[2] - temp_boxA[0]) * (temp_boxA[3] - temp_boxA[1]))
+    boxBArea = abs((temp_boxB[2] - temp_boxB[0]) * (temp_boxB[3] - temp_boxB[1]))
+
+    # compute the intersection over union by taking the intersection
+    # area and dividing it by the sum of prediction + ground-truth
+    # areas - the intersection area
+    iou = interArea / float(boxAArea + boxBArea - interArea)
+
+    # return the intersection over union value
+    return 1 - iou
+
+
+def iou_distance_matrix(bboxes):
+    """Compute the IoU distance between every pair of boxes at once
+    :param bboxes: sequence of boxes in (x, y, w, h) format
+    :return: square array with bb_iou(bboxes[i], bboxes[j]) in cell (i, j)
+    """
+    boxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+
+    # Compute edges
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+
+    # Determine the sides of the intersection rectangle of each pair
+    inter_w = np.minimum(x2[:, None], x2[None, :]) - np.maximum(
+        x1[:, None], x1[None, :]
+    )
+    inter_h = np.minimum(y2[:, None], y2[None, :]) - np.maximum(
+        y1[:, None], y1[None, :]
+    )
+    inter_area = np.abs(np.maximum(inter_w, 0) * np.maximum(inter_h, 0))
+
+    # Compute the area of each box and the union of each pair
+    areas = np.abs((x2 - x1) * (y2 - y1))
+    union_area = areas[:, None] + areas[None, :] - inter_area
+
+    # Boxes that do not overlap are at the maximum distance
+    with np.errstate(divide="ignore", invalid="ignore"):
+        distances = 1 - inter_area / union_area
+    distances[inter_area == 0] = 1
+
+    return distances
+
+
+@profile_utils.timed("consensus")
+def filter_bboxes(total_users, users, bboxes, obj, eps, iua, precomputed=True):
+    profile_utils.add_rows(len(bboxes))
+
+    # If at least half of those who saw this frame decided that there was an object
+    user_count = pd.Series(users).nunique()
+    if user_count / total_users >= obj:
+        # Get clusters of annotation boxes based on iou criterion
+        if precomputed:
+            cluster_ids = DBSCAN(
+                min_samples=1, metric="precomputed", eps=eps
+            ).fit_predict(iou_distance_matrix(bboxes))
+        else:
+            cluster_ids = DBSCAN(min_samples=1, metric=bb_iou, eps=eps).fit_predict(
+                bboxes
+            )
+        # Count the number of users within each cluster
+        counter_dict = Counter(cluster_ids)
+        # Accept a cluster assignment if at least 80% of users agree on annotation
+        passing_ids = [k for k, v in counter_dict.items() if v / user_count >= iua]
+
+        indices = np.isin(cluster_ids, passing_ids)
+
+        final_boxes = []
+        for i in passing_ids:
+            # Compute median over all accepted bounding boxes
+            boxes = np.median(np.array(bboxes)[np.where(cluster_ids == i)], axis=0)
+            final_boxes.append(boxes)
+
+        return indices, final_boxes
+
+    else:
+        return [], bboxes
+
+
+@profile_utils.timed("consensus")
+def aggregate_frame_boxes(boxes_df, obj, eps, iua):
+    """Reach a consensus on the boxes drawn on each frame, in a single grouped pass
+    :param boxes_df: data frame with a row per box and columns user, movie_id, label,
+        start_frame, x, y, w, h and subject_id, with null boxes for users that drew nothing
+    :param obj: proportion of users that must draw a box on a frame
+    :param eps: threshold of iou for clustering
+    :param iua: proportion of users agreeing on clustering
+    :return: data frame with the consensus boxes and columns movie_id, label,
+        start_frame, subject_id, x, y, w and h
+    """
+    keys = ["movie_id", "label", "start_frame"]
+
+    # Count the users that saw each frame, whether or not they drew a box
+    total_users = boxes_df.groupby(keys, observed=True)["user"].nunique()
+
+    # Sort the boxes by frame, keeping their order within each frame,
+    # so that the boxes of each frame are a contiguous slice
+    annotations = boxes_df[boxes_df["x"].notnull()].dropna(subset=keys)
+    annotations = annotations.sort_values(keys, kind="mergesort")
+
+    # Count the boxes of each frame in order of appearance, which is the sorted
+    # order, as categorical keys are not always sorted by groupby
+    sizes = annotations.groupby(keys, sort=False, observed=True).size()
+    ends = np.cumsum(sizes.values)
+    starts = ends - sizes.values
+    totals = total_users.reindex(sizes.index).values
+
+    users = annotations["user"].values
+    bboxes = annotations[["x", "y", "w", "h"]].to_numpy(dtype=float)
+    subject_ids = annotations["subject_id"].values
+
+    new_rows = []
+    for (movie_id, label, start_frame), start, end, total in zip(
+        sizes.index, starts, ends, totals
+    ):
+        # Filter bboxes using IOU metric (essentially a consensus metric)
+        # Keep only bboxes where mean overlap exceeds this threshold
+        indices, new_group = filter_bboxes(
+            total_users=total,
+            users=users[start:end],
+            bboxes=bboxes[start:end],
+            obj=obj,
+            eps=eps,
+            iua=iua,
+        )
+
+        for ix, box in zip(subject_ids[start:end][indices], new_group):
+            new_rows.append((movie_id, label, start_frame, ix) + tuple(box))
+
+    return pd.DataFrame(
+        new_rows,
+        columns=["movie_id", "label", "start_frame", "subject_id", "x", "y", "w", "h"],
+    )
@@ -2,21 +2,49 @@ import sqlite3
 import requests
 import pandas as pd
 import numpy as np
-import io
+import io, os
+from utils import profile_utils
 
 # Utility functions for common database operations
 
+# Settings of every connection: write-ahead logging, fewer fsyncs and a 64 MB page cache
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -64000",
+    "PRAGMA temp_store = MEMORY",
+]
+
+# Enforce the foreign keys of the tables, which rejects whole chunks of rows
+# pointing at missing parents. Off unless KOSTER_FOREIGN_KEYS=1
+FOREIGN_KEYS = os.environ.get("KOSTER_FOREIGN_KEYS", "0") == "1"
+
+# Number of rows written per transaction
+CHUNK_SIZE = 10000
+
+# Connections opened by this process, by database file
+_connections = {}
+
 
 def create_connection(db_file):
     """create a database connection to the SQLite database
-        specified by db_file
+        specified by db_file, reusing the connection already
+        opened by this process
     :param db_file: database file
     :return: Connection object or None
     """
+    key = (os.getpid(), os.path.abspath(db_file))
+    if key in _connections:
+        return _connections[key]
+
     conn = None
     try:
         conn = sqlite3.connect(db_file)
-        conn.execute("PRAGMA foreign_keys = 1")
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if FOREIGN_KEYS:
+            conn.execute("PRAGMA foreign_keys = 1")
+        _connections[key] = conn
         return conn
     except sqlite3.Error as e:
         print(e)
@@ -24,6 +52,59 @@ def create_connection(db_file):
     return conn
 
 
+def get_unique_keys(conn, table):
+    """
+    Get the columns of the UNIQUE constraint or index of a table
+    :param conn: the Connection object
+    :param table: table of interest
+    :return: list of column names, or the primary key if the table has no UNIQUE constraint
+    """
+    for index in conn.execute(f"PRAGMA index_list({table})").fetchall():
+        # Columns: seq, name, unique, origin, partial. Unique indexes added by
+        # migrations ("c") are keys as well as UNIQUE constraints ("u")
+        if index[2] and index[3] in ("u", "c") and not index[4]:
+            return [
+                i[2] for i in conn.execute(f"PRAGMA index_info({index[1]})").fetchall()
+            ]
+
+    return [i[1] for i in conn.execute(f"PRAGMA table_info({table})").fetchall() if i[5]]
+
+
+@profile_utils.timed("db_write")
+def upsert_many(conn, data, table, update=True, chunk_size=CHUNK_SIZE):
+    """
+    Insert multiple rows into table, updating (or keeping) the rows that
+    conflict with its UNIQUE constraint. Rows are written in chunked transactions
+    :param conn: the Connection object
+    :param data: data to be inserted into table, with a value for every column
+    :param table: table of interest
+    :param update: update the conflicting rows, otherwise keep them unchanged
+    :param chunk_size: number of rows written per transaction
+    :return:
+    """
+    columns = [i[1] for i in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+    keys = get_unique_keys(conn, table)
+    values = ", ".join(["?"] * len(columns))
+
+    # Update every column that is neither part of the key nor the primary key
+    pk = [i[1] for i in conn.execute(f"PRAGMA table_info({table})").fetchall() if i[5]]
+    updates = [c for c in columns if c not in keys and c not in pk]
+
+    if update and len(updates) > 0:
+        conflict = "DO UPDATE SET " + ", ".join(f"{c}=excluded.{c}" for c in updates)
+    else:
+        conflict = "DO NOTHING"
+
+    sql = f"INSERT INTO {table} VALUES ({values}) ON CONFLICT ({', '.join(keys)}) {conflict}"
+
+    data = list(data)
+    profile_utils.add_rows(len(data))
+    for i in range(0, len(data), chunk_size):
+        with conn:
+            conn.executemany(sql, data[i : i + chunk_size])
+
+
+@profile_utils.timed("db_write")
 def insert_many(conn, data, table, count):
     """
     Insert multiple rows into table
@@ -37,6 +118,9 @@ def insert_many(conn, data, table, count):
     values = (1,) * count
     values = str(values).replace("1", "?")
 
+    data = list(data)
+    profile_utils.add_rows(len(data))
+
     cur = conn.cursor()
     cur.executemany(f"INSERT INTO {table} VALUES {values}", data)
 
@@ -59,6 +143,21 @@ def retrieve_query(conn, query):
     return rows
 
 
+def create_temp_ids(conn, table, ids):
+    """Stage a list of ids in a temporary table, so that queries can join
+        against it instead of formatting the ids into the SQL
+    :param conn: Connection object
+    :param table: name of the temporary table, replaced if it exists
+    :param ids: ids to stage
+    :return:
+    """
+    conn.execute(f"DROP TABLE IF EXISTS temp.{table}")
+    conn.execute(f"CREATE TEMP TABLE {table} (id integer PRIMARY KEY)")
+    conn.executemany(
+        f"INSERT OR IGNORE INTO temp.{table} VALUES (?)", [(int(i),) for i in ids]
+    )
+
+
 def execute_sql(conn, sql):
     """Execute multiple SQL statements without return
     :param conn: Connection object
@@ -72,17 +171,73 @@ def execute_sql(conn, sql):
         print(e)
 
 
-def add_to_table(db_path, table_name, values, num_fields):
+def apply_migrations(conn, migrations):
+    """Apply the migrations that a database has not received yet
+    :param conn: Connection object
+    :param migrations: list of (version, description, sql) tuples
+    :return: the version of the database
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version (version integer PRIMARY KEY, description text NULL, applied_on datetime NULL)"
+    )
+    current = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
 
-    conn = create_connection(db_path)
+    for version, description, sql in sorted(migrations):
+        if version <= current:
+            continue
+
+        # Apply the migration and record it in a single transaction
+        description = description.replace("'", "''")
+        try:
+            conn.executescript(
+                f"BEGIN; {sql} INSERT INTO schema_version VALUES ({version}, '{description}', datetime('now')); COMMIT;"
+            )
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+        current = version
+        print(f"Applied migration {version}: {description}")
+
+    return current
 
+
+def check_schema(conn, version):
+    """Fail with a clear message when a database has not received the migrations
+    up to a version, instead of failing later on a missing table
+    :param conn: Connection object
+    :param version: the version the caller needs
+    :return: the version of the database
+    """
     try:
-        insert_many(
-            conn,
-            values,
-            table_name,
-            num_fields,
+        current = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0]
+    except sqlite3.OperationalError:
+        current = None
+
+    if (current or 0) < version:
+        raise RuntimeError(
+            f"The database is at schema version {current or 0} but version {version} is needed, "
+            "please run db_setup/init.py on it to upgrade it"
         )
+    return current
+
+
+@profile_utils.timed("db_write")
+def add_to_table(db_path, table_name, values, num_fields, update=True):
+
+    conn = create_connection(db_path)
+
+    try:
+        # Tables without a key can only be appended to
+        if len(get_unique_keys(conn, table_name)) > 0:
+            upsert_many(conn, values, table_name, update)
+        else:
+            insert_many(
+                conn,
+                values,
+                table_name,
+                num_fields,
+            )
     except sqlite3.Error as e:
         print(e)
 
@@ -121,6 +276,67 @@ def get_id(row, field_name, table_name, conn, conditions={"a": "=b"}):
     return id_value
 
 
+def get_last_classification_id(conn, workflow_id):
+    """Get the id of the last classification aggregated for a workflow
+    :param conn: the Connection object
+    :param workflow_id: the Zooniverse workflow
+    :return: classification id or None if the workflow has not been aggregated
+    """
+    rows = retrieve_query(
+        conn,
+        f"SELECT last_classification_id FROM aggregation_state WHERE workflow_id={int(workflow_id)}",
+    )
+    return rows[0][0] if len(rows) > 0 else None
+
+
+def set_last_classification_id(conn, workflow_id, classification_id):
+    """Record the id of the last classification aggregated for a workflow
+    :param conn: the Connection object
+    :param workflow_id: the Zooniverse workflow
+    :param classification_id: the last classification aggregated
+    :return:
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT OR REPLACE INTO aggregation_state VALUES (?, ?, datetime('now'))",
+        (int(workflow_id), int(classification_id)),
+    )
+
+
+def get_aggregated_at(conn, workflow_id=None):
+    """Get the time of the last aggregation of classifications
+    :param conn: the Connection object
+    :param workflow_id: the Zooniverse workflow, None for any workflow
+    :return: seconds since the epoch, or None if nothing has been aggregated
+    """
+    condition = (
+        f" WHERE workflow_id={int(workflow_id)}" if workflow_id is not None else ""
+    )
+    rows = retrieve_query(
+        conn,
+        f"SELECT strftime('%s', MAX(updated_at)) FROM aggregation_state{condition}",
+    )
+    return float(rows[0][0]) if len(rows) > 0 and rows[0][0] is not None else None
+
+
+@profile_utils.timed("db_write")
+def replace_subject_rows(conn, table, subject_ids, data, count):
+    """
+    Replace the rows of some subjects in a table of aggregated annotations
+    :param conn: the Connection object
+    :param table: table of interest
+    :param subject_ids: subjects whose rows are replaced
+    :param data: new rows of the subjects
+    :param count: number of fields
+    :return:
+    """
+    cur = conn.cursor()
+    cur.executemany(
+        f"DELETE FROM {table} WHERE subject_id=?", [(int(i),) for i in subject_ids]
+    )
+    insert_many(conn, data, table, count)
+
+
 def unswedify(string):
     """Convert ä and ö to utf-8"""
     return (
@@ -169,6 +385,26 @@ def find_duplicated_clips(conn):
     return times_uploaded_df["times"].value_counts()
 
 
+# Function to find all the subjects duplicated with any of the given subjects
+def expand_duplicates(subject_ids, duplicates_file_id):
+
+    # Download the csv with information about duplicated subjects
+    dups_df = download_csv_from_google_drive(duplicates_file_id)
+
+    # Select the groups of duplicates that include any of the subjects
+    single_ids = dups_df[
+        dups_df.dupl_subject_id.isin(subject_ids)
+        | dups_df.single_subject_id.isin(subject_ids)
+    ].single_subject_id
+    groups_df = dups_df[dups_df.single_subject_id.isin(single_ids)]
+
+    return (
+        set(subject_ids)
+        | set(groups_df.dupl_subject_id.astype(int))
+        | set(groups_df.single_subject_id.astype(int))
+    )
+
+
 # Function to combine classifications received on duplicated subjects
 def combine_duplicates(annot_df, duplicates_file_id):
 
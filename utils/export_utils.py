@@ -0,0 +1,270 @@
+import io, os, json, gzip, shutil, time
+import pandas as pd
+from pandas.api.types import union_categoricals
+from utils import profile_utils
+
+# Utility functions to read the exports of the Zooniverse project
+
+# Folder where the exports are cached and seconds they are used without checking Zooniverse
+EXPORT_CACHE_DIR = os.environ.get(
+    "KOSTER_EXPORT_CACHE", os.path.join(os.path.expanduser("~"), ".koster_exports")
+)
+EXPORT_MAX_AGE = 24 * 60 * 60
+
+# Number of rows parsed at a time from an export
+CHUNKSIZE = 50000
+
+# Types of the columns shared by the classifications exports, with repeated
+# strings stored once as categories
+CLASSIFICATION_DTYPES = {
+    "classification_id": "int64",
+    "subject_ids": "int64",
+    "workflow_id": "int32",
+    "workflow_version": "float64",
+    "user_name": "category",
+}
+
+
+def open_export(export):
+    """Get a text stream over the body of a Zooniverse export without
+        decoding the whole body into a single string
+    :param export: the response of project.get_export, a file path or a file object
+    :return: a file path or file object that pd.read_csv can read from
+    """
+    # Paths and file objects can be read directly
+    if not hasattr(export, "content"):
+        return export
+
+    # Read from the socket if the body has not been downloaded yet
+    raw = getattr(export, "raw", None)
+    if raw is not None and not getattr(export, "_content_consumed", True):
+        raw.decode_content = True
+        return io.TextIOWrapper(raw, encoding="utf-8", newline="")
+
+    return io.TextIOWrapper(io.BytesIO(export.content), encoding="utf-8", newline="")
+
+
+def read_export_chunks(
+    export,
+    usecols=None,
+    workflow_id=None,
+    workflow_version=None,
+    chunksize=CHUNKSIZE,
+    row_filter=None,
+    skip_empty=True,
+    dtype=None,
+):
+    """Parse a Zooniverse export in chunks, keeping only the rows of interest
+    :param export: the response of project.get_export, a file path or a file object
+    :param usecols: columns to parse from the export
+    :param workflow_id: keep only classifications of this workflow
+    :param workflow_version: keep only classifications from this workflow version onwards
+    :param chunksize: number of rows parsed at a time
+    :param row_filter: function returning a boolean mask for each chunk
+    :param skip_empty: do not yield chunks without rows of interest
+    :param dtype: types of the parsed columns, e.g. CLASSIFICATION_DTYPES
+    :return: generator of data frames
+    """
+    dtype = {k: v for k, v in (dtype or {}).items() if usecols is None or k in usecols}
+
+    for chunk in pd.read_csv(
+        open_export(export), usecols=usecols, dtype=dtype, chunksize=chunksize
+    ):
+        # Filter the classifications of the workflow of interest
+        if workflow_id is not None:
+            chunk = chunk[chunk.workflow_id == workflow_id]
+        if workflow_version is not None:
+            chunk = chunk[chunk.workflow_version >= workflow_version]
+        if row_filter is not None:
+            chunk = chunk[row_filter(chunk)]
+
+        if len(chunk) > 0 or not skip_empty:
+            yield chunk
+
+
+def concat_chunks(chunks):
+    """Concatenate the chunks of an export, keeping the categorical columns
+    categorical even if the chunks have different categories"""
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            categories = union_categoricals([chunk[col] for chunk in chunks]).categories
+            chunks = [
+                chunk.assign(**{col: chunk[col].cat.set_categories(categories)})
+                for chunk in chunks
+            ]
+
+    return pd.concat(chunks, ignore_index=True)
+
+
+@profile_utils.timed("csv_parse")
+def read_export(export, usecols=None, **kwargs):
+    """Parse the rows of interest of a Zooniverse export into a single data frame
+    :param export: the response of project.get_export, a file path or a file object
+    :param usecols: columns to parse from the export
+    :param kwargs: filters passed to read_export_chunks
+    :return: data frame with a fresh index
+    """
+    # Empty chunks are kept so that the columns survive when no rows match
+    chunks = list(
+        read_export_chunks(export, usecols=usecols, skip_empty=False, **kwargs)
+    )
+
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=usecols)
+
+    return concat_chunks(chunks)
+
+
+@profile_utils.timed("csv_parse")
+def read_new_classifications(
+    export,
+    usecols,
+    workflow_id,
+    workflow_version,
+    last_classification_id=None,
+    expand_subjects=None,
+    **kwargs,
+):
+    """Parse all the classifications of the subjects that received
+        classifications after the last one aggregated
+    :param export: the cached classifications export or a file object
+    :param usecols: columns to parse from the export
+    :param workflow_id: keep only classifications of this workflow
+    :param workflow_version: keep only classifications from this workflow version onwards
+    :param last_classification_id: id of the last classification aggregated, None for all
+    :param expand_subjects: function adding related (e.g. duplicated) subjects to a set
+    :param kwargs: other arguments passed to read_export
+    :return: data frame of classifications, ids of the affected subjects
+        and id of the newest classification
+    """
+    # Find the subjects with new classifications reading only the ids
+    new_df = read_export(
+        export,
+        usecols=["classification_id", "subject_ids", "workflow_id", "workflow_version"],
+        workflow_id=workflow_id,
+        workflow_version=workflow_version,
+        row_filter=(
+            None
+            if last_classification_id is None
+            else lambda chunk: chunk.classification_id > last_classification_id
+        ),
+        dtype=CLASSIFICATION_DTYPES,
+    )
+
+    subject_ids = set(new_df.subject_ids)
+    if expand_subjects is not None and len(subject_ids) > 0:
+        subject_ids = expand_subjects(subject_ids)
+
+    # Parse the old and new classifications of those subjects
+    class_df = read_export(
+        export,
+        usecols=usecols,
+        workflow_id=workflow_id,
+        workflow_version=workflow_version,
+        row_filter=lambda chunk: chunk.subject_ids.isin(subject_ids),
+        dtype=CLASSIFICATION_DTYPES,
+        **kwargs,
+    )
+
+    last_id = (
+        new_df.classification_id.max() if len(new_df) > 0 else last_classification_id
+    )
+
+    return class_df, subject_ids, last_id
+
+
+def export_cache_path(project, export_type, cache_dir=EXPORT_CACHE_DIR):
+    """Get the path of the cached copy of a Zooniverse export
+    :param project: the Zooniverse project
+    :param export_type: type of export, e.g. "classifications" or "subjects"
+    :param cache_dir: folder of the export cache
+    :return: path of the compressed export
+    """
+    project_id = getattr(project, "id", None)
+    if not project_id:
+        # Exports of different projects would overwrite each other's cache
+        raise ValueError("The project has no id to key its cached exports")
+    return os.path.join(cache_dir, f"{project_id}_{export_type}.csv.gz")
+
+
+def export_generated_at(project, export_type):
+    """Get the time when Zooniverse last generated an export, if the project can tell"""
+    try:
+        description = project.describe_export(export_type)
+        return str(description["media"][0]["updated_at"])
+    except Exception:
+        return None
+
+
+def download_export(project, export_type, path):
+    """Download a Zooniverse export and store it compressed on disk
+    :param project: the Zooniverse project
+    :param export_type: type of export, e.g. "classifications" or "subjects"
+    :param path: path of the compressed export
+    """
+    export = project.get_export(export_type)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    # Write to a temporary file so that an interrupted download never looks cached
+    tmp_path = path + ".part"
+    with gzip.open(tmp_path, "wb") as f:
+        raw = getattr(export, "raw", None)
+        if raw is not None and not getattr(export, "_content_consumed", True):
+            raw.decode_content = True
+            shutil.copyfileobj(raw, f)
+        else:
+            f.write(export.content)
+    os.replace(tmp_path, path)
+
+
+@profile_utils.timed("export_download")
+def get_export(
+    project,
+    export_type,
+    cache_dir=EXPORT_CACHE_DIR,
+    max_age=EXPORT_MAX_AGE,
+    refresh=False,
+):
+    """Get a Zooniverse export from the local cache, downloading it only when needed
+    :param project: the Zooniverse project (any object with get_export)
+    :param export_type: type of export, e.g. "classifications" or "subjects"
+    :param cache_dir: folder of the export cache
+    :param max_age: seconds a cached export is used without checking Zooniverse
+    :param refresh: download the export even if it is cached
+    :return: path of the compressed export, readable by read_export
+    """
+    path = export_cache_path(project, export_type, cache_dir)
+    meta_path = path + ".json"
+
+    meta = {}
+    if os.path.isfile(path) and os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    if meta and not refresh:
+        # Use recent exports without asking Zooniverse
+        if time.time() - meta["fetched_at"] <= max_age:
+            print(f"Using cached {export_type} export")
+            return path
+
+        # Use older exports if Zooniverse has not generated a newer one
+        generated_at = export_generated_at(project, export_type)
+        if generated_at is not None and generated_at == meta.get("generated_at"):
+            meta["fetched_at"] = time.time()
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+            print(f"Using cached {export_type} export")
+            return path
+
+    # Download the export and record when it was generated
+    download_export(project, export_type, path)
+    meta = {
+        "fetched_at": time.time(),
+        "generated_at": export_generated_at(project, export_type),
+    }
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+    print(f"Downloaded {export_type} export")
+    return path
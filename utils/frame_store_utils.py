@@ -0,0 +1,141 @@
+import os, shutil, hashlib
+from PIL import Image
+
+# Utility functions to keep the frames extracted from the movies between runs,
+# so that a frame wanted by several species or exports is decoded and encoded once
+
+# Folder of the frame store and MB it may use before the least recently used frames are evicted
+FRAME_STORE_DIR = os.environ.get(
+    "KOSTER_FRAME_STORE",
+    os.path.join(os.path.expanduser("~"), ".koster_frame_store"),
+)
+FRAME_STORE_MAX_MB = float(os.environ.get("KOSTER_FRAME_STORE_MB", 10240))
+
+# Settings of the JPEG encoder, part of the key of the stored frames
+ENCODE_SETTINGS = {"format": "JPEG", "quality": 75}
+
+# Bytes read from each end of a movie to fingerprint its content
+FINGERPRINT_BYTES = 1 << 20
+
+
+def movie_fingerprint(movie_path):
+    """Fingerprint the content of a movie from its size and the bytes at both ends,
+    which stays the same when the movie is renamed or moved
+    :param movie_path: path of the movie
+    :return: hex digest
+    """
+    size = os.path.getsize(movie_path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(movie_path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, size - FINGERPRINT_BYTES))
+            digest.update(f.read(FINGERPRINT_BYTES))
+    return digest.hexdigest()
+
+
+def settings_key(settings=ENCODE_SETTINGS):
+    """Get a short key of the encode settings"""
+    return hashlib.sha1(repr(sorted(settings.items())).encode()).hexdigest()[:8]
+
+
+class FrameStore:
+    """Frames encoded once and keyed by (movie fingerprint, frame number, encode settings).
+    Frames are handed out as hardlinks (or copies across file systems) to the
+    paths requested, and the least recently used frames are evicted beyond a size cap
+    """
+
+    def __init__(
+        self,
+        root=FRAME_STORE_DIR,
+        max_mb=FRAME_STORE_MAX_MB,
+        settings=ENCODE_SETTINGS,
+    ):
+        self.root = root
+        self.max_mb = max_mb
+        self.settings = settings
+        self.settings_key = settings_key(settings)
+        self.stats = {"hits": 0, "misses": 0, "links": 0, "evicted": 0}
+
+    def path(self, fingerprint, frame_number):
+        """Get the path of a frame in the store"""
+        return os.path.join(
+            self.root,
+            fingerprint[:2],
+            f"{fingerprint}_{int(frame_number)}_{self.settings_key}.jpg",
+        )
+
+    def get(self, fingerprint, frame_number):
+        """Get the path of a stored frame, or None if it is not stored"""
+        path = self.path(fingerprint, frame_number)
+        if not os.path.isfile(path):
+            self.stats["misses"] += 1
+            return None
+
+        # Mark the frame as recently used
+        os.utime(path)
+        self.stats["hits"] += 1
+        return path
+
+    def put(self, fingerprint, frame_number, frame):
+        """Encode a frame into the store
+        :param frame: RGB array
+        :return: path of the stored frame
+        """
+        path = self.path(fingerprint, frame_number)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file so that an interrupted write never looks stored
+        tmp_path = f"{path}.{os.getpid()}.part"
+        Image.fromarray(frame).save(tmp_path, **self.settings)
+        os.replace(tmp_path, path)
+        return path
+
+    def link(self, path, out_paths):
+        """Hand out a stored frame at the paths requested"""
+        for out_path in out_paths:
+            if os.path.lexists(out_path):
+                if os.path.samefile(path, out_path):
+                    continue
+                os.remove(out_path)
+            try:
+                os.link(path, out_path)
+            except OSError:
+                shutil.copyfile(path, out_path)
+            self.stats["links"] += 1
+
+    def evict(self):
+        """Delete the least recently used frames until the store fits its size cap
+        :return: number of frames evicted
+        """
+        frames = []
+        for folder, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                frames.append((stat.st_mtime, stat.st_size, path))
+
+        size, max_size = sum(i[1] for i in frames), self.max_mb * 2**20
+        n_evicted = 0
+        for _, frame_size, path in sorted(frames):
+            if size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= frame_size
+            n_evicted += 1
+
+        self.stats["evicted"] += n_evicted
+        return n_evicted
+
+    def report(self):
+        requested = self.stats["hits"] + self.stats["misses"]
+        print(
+            f"Frame store: {self.stats['hits']} hits and {self.stats['misses']} misses "
+            f"out of {requested} frames, {self.stats['evicted']} frames evicted"
+        )
@@ -1,39 +1,125 @@
 import os, sys, re
 import argparse
-import pims
 import db_utils
+from video_utils import FrameFetcher
+from utils import profile_utils
 import numpy as np
 import cv2 as cv
 import pandas as pd
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 
-def drawBoxes(df, movie_dir, out_path):
+# Number of frames waiting to be written per encoder worker
+FRAMES_PER_WRITER = 2
+
+
+def draw_boxes(frame, boxes, color=(255, 0, 0), thickness=1):
+    """Draw several boxes on a frame in a single call
+    :param frame: image array, drawn in place
+    :param boxes: array of boxes in (x, y, w, h) format
+    :return: the frame
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+
+    # Add the sizes before truncating, as int(x + w) can differ from int(x) + int(w)
+    x1, y1 = boxes[:, 0].astype(np.int32), boxes[:, 1].astype(np.int32)
+    x2 = (boxes[:, 0] + boxes[:, 2]).astype(np.int32)
+    y2 = (boxes[:, 1] + boxes[:, 3]).astype(np.int32)
+
+    # Corners of each box, drawn as closed polygons
+    corners = np.stack([x1, y1, x2, y1, x2, y2, x1, y2], axis=1).reshape(-1, 4, 2)
+    cv.polylines(frame, list(corners), True, color, thickness)
+    return frame
+
+
+def get_outdated(out_paths, movie_path, since=None):
+    """Select the outputs that are missing or older than their movie
+    :param out_paths: paths of the frames with boxes drawn
+    :param movie_path: path of the movie of the frames
+    :param since: time of the last change of the annotations, e.g. of their last aggregation
+    :return: boolean array, True for the outputs to draw
+    """
+    newest_source = max(os.path.getmtime(movie_path), since or 0)
+    return np.array(
+        [
+            not os.path.exists(path) or os.path.getmtime(path) < newest_source
+            for path in out_paths
+        ],
+        dtype=bool,
+    )
+
+
+@profile_utils.timed("frame_decode")
+def drawBoxes(df, movie_dir, out_path, n_workers=4, since=None, overwrite=False):
+    """Draw the boxes of each frame, decoding the frames once per movie
+    :param df: data frame with filename, frame_number, species_id and box columns
+    :param movie_dir: directory of the movie files
+    :param out_path: directory to save the frames
+    :param n_workers: number of threads encoding and writing frames
+    :param since: time of the last change of the annotations, outputs older than it are redrawn
+    :param overwrite: draw all frames even if their output is up to date
+    :return: number of frames written
+    """
+    df = df.copy()
     df["movie_path"] = (
         movie_dir
         + "/"
-        + df["filename"].apply(
-            lambda x: os.path.basename(x.rsplit("_frame_")[0]) + ".mov"
-        )
+        + df["filename"].str.rsplit("_frame_", n=1).str[0].map(os.path.basename)
+        + ".mov"
     )
-    movie_dict = {i: pims.Video(i) for i in df["movie_path"].unique()}
-    df["annotation"] = df[["x_position", "y_position", "width", "height"]].apply(
-        lambda x: tuple([x[0], x[1], x[2], x[3]]), 1
-    )
-    df = df.drop(columns=["x_position", "y_position", "width", "height"])
-    for name, group in tqdm(
-        df.groupby(["movie_path", "frame_number", "species_id", "filename"])
-    ):
-        frame = movie_dict[name[0]][name[1]]
-        boxes = [tuple(i[4:])[0] for i in group.values]
-        for box in boxes:
-            # Calculating end-point of bounding box based on starting point and w, h
-            end_box = tuple([int(box[0] + box[2]), int(box[1] + box[3])])
-            # changed color and width to make it visible
-            cv.rectangle(frame, (int(box[0]), int(box[1])), end_box, (255, 0, 0), 1)
-        if not os.path.exists(out_path):
-            os.mkdir(out_path)
-        cv.imwrite(out_path + "/" + os.path.basename(name[3]), frame)
+    df["out_path"] = out_path + "/" + df["filename"].map(os.path.basename)
+    os.makedirs(out_path, exist_ok=True)
+
+    fetcher = FrameFetcher()
+    n_written, n_skipped, missing_movies = 0, 0, []
+    pending = []
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        for movie_path, movie_df in tqdm(df.groupby("movie_path"), desc="Movies"):
+            if not os.path.isfile(movie_path):
+                missing_movies.append(movie_path)
+                continue
+
+            # Skip the frames whose output is already up to date
+            out_paths = movie_df["out_path"].unique()
+            if not overwrite:
+                outdated = get_outdated(out_paths, movie_path, since)
+                n_skipped += int((~outdated).sum())
+                movie_df = movie_df[movie_df["out_path"].isin(out_paths[outdated])]
+            if len(movie_df) == 0:
+                continue
+
+            # Get the boxes of each output, and the outputs of each frame
+            frame_outputs = {}
+            for (frame_number, path), group in movie_df.groupby(
+                ["frame_number", "out_path"]
+            ):
+                boxes = group[["x_position", "y_position", "width", "height"]].values
+                frame_outputs.setdefault(int(frame_number), []).append((path, boxes))
+
+            # Decode each frame once and hand its outputs to the writers
+            for frame_number, frame in fetcher.iter_movie(movie_path, frame_outputs):
+                outputs = frame_outputs[frame_number]
+                for i, (path, boxes) in enumerate(outputs):
+                    # The last output of a frame can be drawn on the decoded frame itself
+                    image = frame if i == len(outputs) - 1 else frame.copy()
+                    draw_boxes(image, boxes)
+                    pending.append(executor.submit(cv.imwrite, path, image))
+                    n_written += 1
+
+                    # Wait for the writers before decoding too far ahead
+                    while len(pending) > FRAMES_PER_WRITER * max(1, n_workers):
+                        pending.pop(0).result()
+
+        for future in pending:
+            future.result()
+
+    fetcher.report()
+    for movie_path in missing_movies:
+        print(f"Movie not found: {movie_path}")
+    print(f"{n_written} frames written, {n_skipped} already up to date")
+    return n_written
 
 
 def main():
@@ -63,13 +149,48 @@ def main():
         default=r"/database/frames/",
         required=True,
     )
+    parser.add_argument(
+        "-nw",
+        "--n_workers",
+        type=int,
+        help="number of threads encoding and writing frames",
+        default=4,
+        required=False,
+    )
+    parser.add_argument(
+        "-zw",
+        "--zoo_workflow",
+        type=float,
+        help="Zooniverse workflow whose last aggregation outdates the frames drawn, any workflow by default",
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        "--overwrite",
+        help="draw all frames even if their output is up to date",
+        action="store_true",
+        required=False,
+    )
+    profile_utils.add_arguments(parser)
     args = parser.parse_args()
+
+    # Measure the stages of the run if asked to
+    profile_utils.setup(args)
+
     conn = db_utils.create_connection(args.db_path)
     df = pd.read_sql_query(
         "SELECT b.filename, b.frame_number, a.species_id, a.x_position, a.y_position, a.width, a.height FROM agg_annotations_frame AS a LEFT JOIN subjects AS b ON a.subject_id=b.id",
         conn,
     )
-    drawBoxes(df, args.movie_dir, args.output_dir)
+    # Redraw the frames saved before the last change of the annotations
+    drawBoxes(
+        df,
+        args.movie_dir,
+        args.output_dir,
+        n_workers=args.n_workers,
+        since=db_utils.get_aggregated_at(conn, args.zoo_workflow),
+        overwrite=args.overwrite,
+    )
     print("Frames exported successfully")
 
 
@@ -0,0 +1,410 @@
+import os, json, subprocess, unicodedata
+import av
+import pandas as pd
+import numpy as np
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+from utils import db_utils
+
+# Utility functions to probe the original movies
+
+# Columns of the movie_probes table
+PROBE_COLUMNS = [
+    "fpath",
+    "size",
+    "mtime",
+    "fps",
+    "duration",
+    "frame_count",
+    "codec",
+    "width",
+    "height",
+    "keyframe_interval",
+    "container_duration",
+]
+
+# Seconds of the movie scanned to estimate the interval between keyframes
+KEYFRAME_SCAN_SECONDS = 60
+
+# Extensions of the files indexed in the movie library
+MOVIE_EXTENSIONS = (".mov", ".mp4", ".avi", ".mkv", ".mpg")
+
+# File where the index of the movie library is kept between runs
+MOVIE_INDEX_PATH = os.environ.get(
+    "KOSTER_MOVIE_INDEX",
+    os.path.join(os.path.expanduser("~"), ".koster_movie_index.json"),
+)
+
+
+def resolve_path(video_file):
+    """Get the path of a movie as found on disk, trying the decomposed
+    swedish characters if needed, or None if the movie is missing"""
+    for path in [video_file, db_utils.unswedify(video_file)]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def movie_key(filename):
+    """Normalise a movie path to its NFC basename without a movie extension,
+    so that paths written with composed or decomposed characters match"""
+    name = unicodedata.normalize("NFC", os.path.basename(str(filename)))
+    base, ext = os.path.splitext(name)
+    return base if ext.lower() in MOVIE_EXTENSIONS else name
+
+
+def scan_movie_roots(roots):
+    """Walk the movie roots once
+    :param roots: folders with the movie files
+    :return: dict of movie paths by movie_key and dict of the mtime of every folder walked
+    """
+    paths, mtimes = {}, {}
+    for root in roots:
+        for folder, _, files in os.walk(root):
+            mtimes[folder] = os.stat(folder).st_mtime
+            for filename in sorted(files):
+                if os.path.splitext(filename)[1].lower() in MOVIE_EXTENSIONS:
+                    # Keep the first movie found for each key, earlier roots first
+                    paths.setdefault(
+                        movie_key(filename), os.path.join(folder, filename)
+                    )
+    return paths, mtimes
+
+
+def index_is_current(index, roots):
+    """Check that an index covers the same roots and that no folder walked has
+    changed, which takes a stat per folder instead of per movie"""
+    if index.get("roots") != list(roots):
+        return False
+    try:
+        return all(
+            os.stat(folder).st_mtime == mtime
+            for folder, mtime in index["mtimes"].items()
+        )
+    except OSError:
+        return False
+
+
+def get_movie_index(roots, index_path=MOVIE_INDEX_PATH, refresh=False):
+    """Get the index of the movie library, scanning the roots only when they have changed
+    :param roots: folders with the movie files
+    :param index_path: file where the index is kept, None to not keep it
+    :param refresh: scan the roots even if the index is current
+    :return: dict of movie paths by movie_key
+    """
+    roots = [os.path.abspath(root) for root in roots]
+
+    if index_path is not None and os.path.isfile(index_path) and not refresh:
+        with open(index_path) as f:
+            index = json.load(f)
+        if index_is_current(index, roots):
+            return index["paths"]
+
+    # Scan the library and keep the index for the next runs
+    paths, mtimes = scan_movie_roots(roots)
+    print(f"Indexed {len(paths)} movies in {len(mtimes)} folders")
+    if index_path is not None:
+        tmp_path = index_path + ".part"
+        with open(tmp_path, "w") as f:
+            json.dump({"roots": roots, "mtimes": mtimes, "paths": paths}, f)
+        os.replace(tmp_path, index_path)
+
+    return paths
+
+
+def resolve_movie_paths(video_files, roots, index_path=MOVIE_INDEX_PATH):
+    """Find the movies of a column of paths in the movie library
+    :param video_files: column of movie paths or filenames, with or without extension
+    :param roots: folders with the movie files
+    :param index_path: file where the index is kept, None to not keep it
+    :return: Series of paths aligned with video_files, NaN for movies not found
+    """
+    paths = get_movie_index(roots, index_path)
+    video_files = pd.Series(video_files)
+    keys = video_files.map(movie_key, na_action="ignore")
+    return keys.map(paths)
+
+
+def ffprobe(args):
+    output = subprocess.check_output(
+        ["ffprobe", "-v", "error", "-of", "json"] + args, stderr=subprocess.DEVNULL
+    )
+    return json.loads(output)
+
+
+def probe_movie(path):
+    """Read the stream facts of a movie
+    :param path: path of the movie
+    :return: dict with fps, duration, frame_count, codec, width, height,
+        keyframe_interval and container_duration (None if unknown)
+    """
+    facts = dict.fromkeys(PROBE_COLUMNS[3:])
+
+    try:
+        info = ffprobe(
+            [
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "stream=codec_name,width,height,avg_frame_rate,nb_frames:format=duration",
+                path,
+            ]
+        )
+        stream = info["streams"][0]
+        num, den = stream["avg_frame_rate"].split("/")
+        facts.update(
+            {
+                "fps": float(num) / float(den) if float(den) > 0 else None,
+                "codec": stream.get("codec_name"),
+                "width": stream.get("width"),
+                "height": stream.get("height"),
+                "frame_count": (
+                    int(stream["nb_frames"]) if "nb_frames" in stream else None
+                ),
+                "container_duration": float(info["format"]["duration"]),
+            }
+        )
+
+        # Estimate the interval between keyframes from the start of the movie
+        packets = ffprobe(
+            [
+                "-select_streams",
+                "v:0",
+                "-read_intervals",
+                f"%+{KEYFRAME_SCAN_SECONDS}",
+                "-show_entries",
+                "packet=pts_time,flags",
+                path,
+            ]
+        )["packets"]
+        keyframes = sorted(
+            float(p["pts_time"])
+            for p in packets
+            if "K" in p.get("flags", "") and "pts_time" in p
+        )
+        if len(keyframes) > 1:
+            facts["keyframe_interval"] = float(np.mean(np.diff(keyframes)))
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError, IndexError):
+        # Fall back to OpenCV when ffprobe is not available or fails
+        cap = cv2.VideoCapture(path)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        cap.release()
+        if fps > 0:
+            facts.update(
+                {
+                    "fps": fps,
+                    "frame_count": frame_count,
+                    "width": width,
+                    "height": height,
+                }
+            )
+
+    # Length of the movie as the number of frames over the frame rate
+    if facts["fps"] and facts["frame_count"]:
+        facts["duration"] = facts["frame_count"] / facts["fps"]
+    else:
+        facts["duration"] = facts["container_duration"]
+
+    return facts
+
+
+def probe_movies(video_files, conn, n_workers=8, roots=None):
+    """Probe many movies at the same time, reusing the facts stored in the
+    movie_probes table for movies whose size and modification time have not changed
+    :param video_files: column of movie paths
+    :param conn: the Connection object
+    :param n_workers: number of movies probed at the same time
+    :param roots: folders of the movie library to find the movies in, by default
+        the movies are looked up at their own path
+    :return: data frame of PROBE_COLUMNS aligned with video_files, fps and duration are NaN for missing movies
+    """
+    video_files = pd.Series(video_files).astype(str)
+    unique_files = video_files.unique()
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # Find and stat the movies, which is slow on network filesystems
+        if roots is not None:
+            paths = [
+                None if pd.isnull(i) else i
+                for i in resolve_movie_paths(unique_files, roots)
+            ]
+        else:
+            paths = list(executor.map(resolve_path, unique_files))
+        stats = list(
+            executor.map(lambda x: os.stat(x) if x is not None else None, paths)
+        )
+        files_df = pd.DataFrame(
+            {
+                "video_file": unique_files,
+                "fpath": paths,
+                "size": [s.st_size if s else None for s in stats],
+                "mtime": [s.st_mtime if s else None for s in stats],
+            }
+        )
+
+        # Get the facts already known of the movies that have not changed
+        cached_df = pd.read_sql_query(
+            f"SELECT {', '.join(PROBE_COLUMNS)} FROM movie_probes", conn
+        )
+        files_df = files_df.merge(cached_df, how="left", on=["fpath", "size", "mtime"])
+
+        # Probe the movies that are new or changed
+        to_probe = files_df["fpath"].notnull() & files_df["fps"].isnull()
+        if to_probe.any():
+            print(f"Probing {to_probe.sum()} of {len(files_df)} movies")
+            facts_df = pd.DataFrame(
+                list(executor.map(probe_movie, files_df.loc[to_probe, "fpath"])),
+                columns=PROBE_COLUMNS[3:],
+            )
+            probed_df = pd.concat(
+                [
+                    files_df.loc[
+                        to_probe, ["video_file", "fpath", "size", "mtime"]
+                    ].reset_index(drop=True),
+                    facts_df,
+                ],
+                axis=1,
+            )
+
+            # Store the facts for the next runs
+            db_utils.upsert_many(
+                conn,
+                [
+                    tuple(
+                        None if pd.isnull(v) else getattr(v, "item", lambda: v)()
+                        for v in row
+                    )
+                    for row in probed_df[PROBE_COLUMNS].astype(object).values
+                ],
+                "movie_probes",
+            )
+
+            files_df = pd.concat([files_df[~to_probe], probed_df], ignore_index=True)
+
+    missing = files_df["fpath"].isnull().sum()
+    if missing > 0:
+        print(f"{missing} movies could not be found")
+
+    probes_df = files_df.set_index("video_file").loc[video_files.values, PROBE_COLUMNS]
+    return probes_df.reset_index(drop=True)
+
+
+def get_byte_rates(video_files, durations, conn):
+    """Estimate the average bytes per second of movies from the size and length
+    probed in movie_probes, falling back to their size on disk and the duration given
+    :param video_files: column of movie paths
+    :param durations: column of the durations of the movies, in seconds
+    :param conn: the Connection object
+    :return: array aligned with video_files of bytes per second, NaN when unknown
+    """
+    files_df = pd.DataFrame(
+        {"fpath": pd.Series(video_files).astype(str).values, "duration": durations}
+    )
+    probes_df = pd.read_sql_query(
+        "SELECT fpath, size, container_duration FROM movie_probes", conn
+    ).drop_duplicates(subset=["fpath"], keep="last")
+    files_df = files_df.merge(probes_df, how="left", on="fpath")
+
+    # Stat the movies that were never probed
+    unprobed = files_df["size"].isnull()
+    if unprobed.any():
+        files_df.loc[unprobed, "size"] = [
+            os.path.getsize(path) if path is not None else np.nan
+            for path in map(resolve_path, files_df.loc[unprobed, "fpath"])
+        ]
+    length = files_df["container_duration"].fillna(files_df["duration"])
+
+    return (files_df["size"] / length.where(length > 0)).values.astype(float)
+
+
+def scan_keyframes(path):
+    """Get the times of the keyframes of a movie from its packets, without decoding
+    :param path: path of the movie
+    :return: sorted list of seconds from the start of the movie, as used by ffmpeg -ss,
+        or None if the movie cannot be read
+    """
+    try:
+        container = av.open(path)
+        try:
+            stream = container.streams.video[0]
+            start = (container.start_time or 0) / av.time_base
+            times = [
+                float(packet.pts * stream.time_base) - start
+                for packet in container.demux(stream)
+                if packet.is_keyframe and packet.pts is not None
+            ]
+        finally:
+            container.close()
+    except (av.AVError, OSError, IndexError, ValueError) as e:
+        print(f"Could not index the keyframes of {path}: {e}")
+        return None
+
+    return sorted(round(i, 6) for i in times)
+
+
+def get_keyframes(video_files, conn, n_workers=8):
+    """Get the keyframe times of many movies, scanning only the movies whose
+    size or modification time changed since they were stored in movie_keyframes
+    :param video_files: column of movie paths
+    :param conn: the Connection object
+    :param n_workers: number of movies scanned at the same time
+    :return: list aligned with video_files of arrays of keyframe seconds, None for missing movies
+    """
+    video_files = pd.Series(video_files).astype(str)
+    unique_files = video_files.unique()
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # Find and stat the movies
+        paths = list(executor.map(resolve_path, unique_files))
+        stats = list(
+            executor.map(lambda x: os.stat(x) if x is not None else None, paths)
+        )
+        files_df = pd.DataFrame(
+            {
+                "video_file": unique_files,
+                "fpath": paths,
+                "size": [s.st_size if s else None for s in stats],
+                "mtime": [s.st_mtime if s else None for s in stats],
+            }
+        )
+
+        # Get the keyframes already indexed of the movies that have not changed
+        cached_df = pd.read_sql_query(
+            "SELECT fpath, size, mtime, keyframes FROM movie_keyframes", conn
+        )
+        files_df = files_df.merge(cached_df, how="left", on=["fpath", "size", "mtime"])
+
+        # Scan the movies that are new or changed
+        to_scan = files_df["fpath"].notnull() & files_df["keyframes"].isnull()
+        if to_scan.any():
+            print(f"Indexing the keyframes of {to_scan.sum()} of {len(files_df)} movies")
+            scanned_df = files_df[to_scan].copy()
+            scanned_df["keyframes"] = [
+                None if i is None else json.dumps(i)
+                for i in executor.map(scan_keyframes, scanned_df["fpath"])
+            ]
+
+            # Leave the movies that could not be read out of the index
+            scanned_df = scanned_df[scanned_df["keyframes"].notnull()]
+
+            # Store the keyframes for the next runs
+            db_utils.upsert_many(
+                conn,
+                [
+                    (fpath, int(size), float(mtime), keyframes)
+                    for fpath, size, mtime, keyframes in scanned_df[
+                        ["fpath", "size", "mtime", "keyframes"]
+                    ].values
+                ],
+                "movie_keyframes",
+            )
+            files_df.loc[scanned_df.index, "keyframes"] = scanned_df["keyframes"]
+
+    keyframes = {
+        video_file: None if pd.isnull(i) else np.array(json.loads(i), dtype=float)
+        for video_file, i in files_df[["video_file", "keyframes"]].values
+    }
+    return [keyframes[i] for i in video_files]
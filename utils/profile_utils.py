@@ -0,0 +1,241 @@
+import os, sys, json, time, atexit, resource, functools, cProfile
+import pandas as pd
+
+# Utility functions to measure the stages of the scripts (export download, CSV parse,
+# JSON flatten, consensus, DB write, frame decode, encode, upload).
+# Measuring is off unless a script is run with --profile (or KOSTER_PROFILE is set)
+# to the path of the JSON report, and --cprofile (or KOSTER_CPROFILE) for a cProfile dump
+
+# Report of this process, None when measuring is off
+_report = None
+
+# Stages running, innermost last
+_active = []
+
+# cProfile of this process and path of its dump
+_profiler = None
+_profile_path = None
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of the process, where Linux allows it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """Get the peak resident memory of the process in MB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def add_arguments(parser):
+    """Add the measuring flags to the argument parser of a script"""
+    parser.add_argument(
+        "--profile",
+        type=str,
+        help="path of a JSON report with the time and memory of each stage",
+        default=os.environ.get("KOSTER_PROFILE"),
+        required=False,
+    )
+    parser.add_argument(
+        "--cprofile",
+        type=str,
+        help="path of a cProfile dump of the whole run",
+        default=os.environ.get("KOSTER_CPROFILE"),
+        required=False,
+    )
+
+
+def setup(args):
+    """Start measuring the stages of a script if its arguments ask for it
+    :param args: parsed arguments of a script with add_arguments
+    :return:
+    """
+    global _report, _profiler, _profile_path
+
+    # Keep measuring from the first call when a process runs several scripts
+    if getattr(args, "profile", None) and _report is None:
+        _report = {
+            "script": os.path.basename(sys.argv[0]),
+            "path": args.profile,
+            "started_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "start": (time.perf_counter(), time.process_time()),
+            "stages": {},
+        }
+        atexit.register(write_report)
+
+    if getattr(args, "cprofile", None) and _profiler is None:
+        _profiler, _profile_path = cProfile.Profile(), args.cprofile
+        _profiler.enable()
+        atexit.register(write_profile)
+
+
+class Stage:
+    """Measure the wall time, CPU time, peak resident memory, rows and
+    size of the output data frame of a stage"""
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.output_mb = None
+
+    def __enter__(self):
+        _active.append(self)
+        self.peak = 0
+        reset_peak_rss()
+        self.start = (time.perf_counter(), time.process_time())
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start[0]
+        cpu = time.process_time() - self.start[1]
+        peak = max(peak_rss_mb(), self.peak)
+        _active.pop()
+
+        # Stages inside this one reset the peak, so pass it on to the outer stage
+        if _active:
+            _active[-1].peak = max(_active[-1].peak, peak)
+
+        record = _report["stages"].setdefault(
+            self.name,
+            {
+                "calls": 0,
+                "wall_s": 0.0,
+                "cpu_s": 0.0,
+                "peak_rss_mb": 0.0,
+                "rows": None,
+                "output_mb": None,
+            },
+        )
+        record["calls"] += 1
+        record["wall_s"] += wall
+        record["cpu_s"] += cpu
+        record["peak_rss_mb"] = max(record["peak_rss_mb"], peak)
+        if self.rows is not None:
+            record["rows"] = (record["rows"] or 0) + int(self.rows)
+        if self.output_mb is not None:
+            record["output_mb"] = max(record["output_mb"] or 0, self.output_mb)
+        return False
+
+
+class _NoStage:
+    rows = None
+    output_mb = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_stage = _NoStage()
+
+
+def stage(name, rows=None):
+    """Context manager measuring a stage, which does nothing when measuring is off.
+    Rows can be given up front or set on the object returned, e.g.
+        with profile_utils.stage("consensus") as s:
+            ...
+            s.rows = len(df)
+    """
+    # Stages called from a stage of the same name are part of it
+    if _report is None or any(i.name == name for i in _active):
+        return _no_stage
+    return Stage(name, rows)
+
+
+def add_rows(n):
+    """Count rows in the innermost stage running, e.g. from a function returning nothing"""
+    if _active:
+        stage = _active[-1]
+        stage.rows = (stage.rows or 0) + n
+
+
+def count_rows(output):
+    """Get the number of rows of the output of a stage, if it has rows"""
+    if isinstance(output, tuple) and len(output) > 0:
+        output = output[0]
+    if isinstance(output, (pd.DataFrame, pd.Series, list, set)):
+        return len(output)
+    return None
+
+
+def output_mb(output):
+    """Get the memory used by the output of a stage in MB, if it is a data frame"""
+    if isinstance(output, tuple) and len(output) > 0:
+        output = output[0]
+    if isinstance(output, pd.DataFrame):
+        return output.memory_usage(deep=True).sum() / 2**20
+    if isinstance(output, pd.Series):
+        return output.memory_usage(deep=True) / 2**20
+    return None
+
+
+def timed(name):
+    """Decorator measuring every call of a function as a stage, counting
+    the rows and memory of the data frame or list it returns"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _report is None:
+                return func(*args, **kwargs)
+            with stage(name) as s:
+                output = func(*args, **kwargs)
+                rows = count_rows(output)
+                if rows is not None:
+                    s.rows = rows
+                s.output_mb = output_mb(output)
+            return output
+
+        return wrapper
+
+    return decorator
+
+
+def write_report():
+    """Write the JSON report of the stages measured"""
+    if _report is None:
+        return
+
+    wall = time.perf_counter() - _report["start"][0]
+    cpu = time.process_time() - _report["start"][1]
+    report = {
+        "script": _report["script"],
+        "started_at": _report["started_at"],
+        "wall_s": round(wall, 4),
+        "cpu_s": round(cpu, 4),
+        "max_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "stages": [
+            dict(
+                {"stage": name},
+                **{k: round(v, 4) if isinstance(v, float) else v for k, v in i.items()},
+            )
+            for name, i in _report["stages"].items()
+        ],
+    }
+    with open(_report["path"], "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Stage report saved to {_report['path']}")
+
+
+def write_profile():
+    """Write the cProfile dump of the run"""
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_path)
+        print(f"cProfile dump saved to {_profile_path}")
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+from utils.movie_utils import movie_key
+
+# Utility functions to resolve the ids of lookup tables (movies, species, sites)
+# for whole columns at once, loading each table only once per run
+
+# Queries and key normalisation of each lookup table
+LOOKUP_TABLES = {
+    "movies": ("SELECT id, filename AS key FROM movies", "filename"),
+    "species": ("SELECT id, label AS key FROM species", "label"),
+    "sites": ("SELECT id, name AS key FROM sites", "name"),
+}
+
+# Lookups loaded by this process, by connection and table
+_lookups = {}
+
+
+def normalize_label(labels):
+    """Normalise species labels, e.g. "Deep-sea (King crab)" -> "DEEP-SEAKINGCRAB" """
+    return pd.Series(labels, dtype=object).str.replace(r"[()\s]", "", regex=True).str.upper()
+
+
+def normalize_filename(filenames):
+    """Normalise movie filenames to their NFC basename without a movie extension,
+    keeping dotted names such as "2021.05.03_x" whole"""
+    filenames = pd.Series(filenames, dtype=object)
+    return filenames.map(lambda x: movie_key(x) if isinstance(x, str) else x)
+
+
+def normalize_name(names):
+    """Normalise site names by removing surrounding whitespace"""
+    return pd.Series(names, dtype=object).str.strip()
+
+
+NORMALIZERS = {
+    "filename": normalize_filename,
+    "label": normalize_label,
+    "name": normalize_name,
+}
+
+
+def get_lookup(conn, table, refresh=False):
+    """Get the hashed index of the keys of a lookup table
+    :param conn: the Connection object
+    :param table: one of "movies", "species" or "sites"
+    :param refresh: reload the table, e.g. after adding rows to it
+    :return: pandas Series of ids indexed by normalised key
+    """
+    if refresh or (id(conn), table) not in _lookups:
+        query, kind = LOOKUP_TABLES[table]
+        df = pd.read_sql_query(query, conn).sort_values("id")
+        keys = NORMALIZERS[kind](df["key"]).values
+        lookup = pd.Series(df["id"].values, index=keys)
+
+        # Leave out the keys that different names normalise to, as they cannot
+        # be told apart. Rows repeating the same name resolve to the lowest id
+        names = df["key"].groupby(keys).nunique()
+        ambiguous = names.index[names > 1]
+        if len(ambiguous) > 0:
+            print(
+                f"{len(ambiguous)} keys of {table} match several rows and will not be resolved: "
+                + str({k: sorted(lookup[[k]].tolist()) for k in ambiguous[:10]})
+            )
+        lookup = lookup[~lookup.index.isin(ambiguous)]
+        _lookups[(id(conn), table)] = lookup[~lookup.index.duplicated(keep="first")]
+
+    return _lookups[(id(conn), table)]
+
+
+def resolve(conn, table, keys, report=True):
+    """Get the ids of the rows of a lookup table matching a column of keys
+    :param conn: the Connection object
+    :param table: one of "movies", "species" or "sites"
+    :param keys: column of keys (filenames, labels or names)
+    :param report: print the keys without a match
+    :return: Series of ids aligned with keys, NaN where there is no match
+    """
+    lookup = get_lookup(conn, table)
+    keys = pd.Series(keys)
+    normalized = NORMALIZERS[LOOKUP_TABLES[table][1]](keys.values)
+
+    # Find the position of every key in the hashed index at once
+    positions = lookup.index.get_indexer(normalized.values)
+    if len(lookup) > 0:
+        ids = np.where(
+            positions >= 0, lookup.values[np.maximum(positions, 0)].astype(float), np.nan
+        )
+    else:
+        ids = np.full(len(keys), np.nan)
+
+    if report and (positions < 0).any():
+        unmatched = keys[positions < 0].dropna().unique()
+        if len(unmatched) > 0:
+            print(f"{len(unmatched)} keys were not found in {table}: {list(unmatched[:10])}")
+
+    return pd.Series(ids, index=keys.index)
@@ -0,0 +1,109 @@
+import av
+from collections import defaultdict
+
+# Utility functions to read frames from the original movies
+
+# Frames up to this many frames ahead of the last decoded frame are reached by
+# decoding forward instead of seeking to the previous keyframe
+MAX_FORWARD_GAP = 250
+
+
+class FrameFetcher:
+    """Decode the frames requested from the movies, one forward pass per movie.
+    Frame numbers are given by the presentation time of the frames (time * fps),
+    the same numbering used by pims.Video
+    """
+
+    def __init__(self, max_gap=MAX_FORWARD_GAP):
+        self.max_gap = max_gap
+        self.stats = {
+            "movies": 0,
+            "requested": 0,
+            "seeks": 0,
+            "decoded": 0,
+            "missing": 0,
+        }
+
+    def iter_movie(self, movie_path, frame_numbers):
+        """Decode some frames of a movie in ascending order
+        :param movie_path: path of the movie
+        :param frame_numbers: frame numbers of interest, in any order
+        :return: generator of (frame_number, RGB array). Only the exact frames
+            requested are yielded, frames the movie has no frame for are counted
+            as missing and skipped
+        """
+        wanted = sorted(set(int(i) for i in frame_numbers))
+        self.stats["movies"] += 1
+        self.stats["requested"] += len(wanted)
+
+        container = av.open(movie_path)
+        try:
+            stream = container.streams.video[0]
+            rate = stream.average_rate
+            time_base = stream.time_base
+            start = stream.start_time or 0
+
+            decoder, current, frame = None, None, None
+            for frame_number in wanted:
+                # The last frame decoded is already past the frame of interest
+                if current is not None and frame_number <= current:
+                    if frame_number == current:
+                        yield frame_number, frame.to_ndarray(format="rgb24")
+                    else:
+                        self.stats["missing"] += 1
+                    continue
+
+                # Seek only when nothing is decoded yet or the frame is too far forward
+                if decoder is None or frame_number - current > self.max_gap:
+                    container.seek(
+                        int(frame_number / rate / time_base) + start,
+                        stream=stream,
+                        backward=True,
+                    )
+                    decoder = container.decode(stream)
+                    self.stats["seeks"] += 1
+
+                # Decode forward until the frame of interest
+                for frame in decoder:
+                    self.stats["decoded"] += 1
+                    current = int(round((frame.pts - start) * time_base * rate))
+                    if current >= frame_number:
+                        break
+                else:
+                    # The movie ended before the frame of interest
+                    decoder, current, frame = None, None, None
+                    self.stats["missing"] += 1
+                    continue
+
+                # Never hand out a later frame under the number requested
+                if current != frame_number:
+                    self.stats["missing"] += 1
+                    continue
+
+                yield frame_number, frame.to_ndarray(format="rgb24")
+        finally:
+            container.close()
+
+    def iter_frames(self, requests):
+        """Decode the frames requested from several movies
+        :param requests: iterable of (movie_path, frame_number)
+        :return: generator of (movie_path, frame_number, RGB array)
+        """
+        # Group and sort the requests per movie
+        movie_frames = defaultdict(set)
+        for movie_path, frame_number in requests:
+            movie_frames[movie_path].add(int(frame_number))
+
+        for movie_path in sorted(movie_frames):
+            for frame_number, frame in self.iter_movie(
+                movie_path, movie_frames[movie_path]
+            ):
+                yield movie_path, frame_number, frame
+
+    def report(self):
+        print(
+            f"Decoded {self.stats['decoded']} frames with {self.stats['seeks']} seeks "
+            f"to get {self.stats['requested']} frames from {self.stats['movies']} movies"
+        )
+        if self.stats["missing"] > 0:
+            print(f"{self.stats['missing']} frames requested were not found in their movie")
@@ -1,9 +1,12 @@
+import os, json, time, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from panoptes_client import (
     SubjectSet,
     Subject,
     Project,
     Panoptes,
 )  # needed to upload clips to Zooniverse
+from utils import profile_utils
 
 
 class AuthenticationError(Exception):
@@ -21,3 +24,164 @@ def auth_session(username, password):
     project = Project(9747)
 
     return project
+
+
+def retry(func, n_retries=5, backoff=1.0):
+    """Call a function, retrying with exponential backoff if it fails
+    :param func: function without arguments
+    :param n_retries: number of attempts
+    :param backoff: seconds to wait after the first failure, doubled after each failure
+    :return: the output of the function
+    """
+    for attempt in range(n_retries):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == n_retries - 1:
+                raise
+            print(f"{e}, retrying in {backoff * 2 ** attempt} seconds")
+            time.sleep(backoff * 2**attempt)
+
+
+def load_manifest(manifest_path):
+    """Read the progress of an upload from its manifest
+    :param manifest_path: path of the manifest, a file with a JSON record per line
+    :return: id and display name of the subject set, dict of saved filenames
+        to subject ids and set of added subject ids
+    """
+    subject_set_id, display_name, saved, added = None, None, {}, set()
+
+    if manifest_path is not None and os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Skip lines cut short by an interrupted upload
+                    continue
+                if "subject_set_id" in record:
+                    subject_set_id = record["subject_set_id"]
+                    display_name = record.get("display_name")
+                if "filename" in record:
+                    saved[record["filename"]] = record["subject_id"]
+                if "added" in record:
+                    added.update(record["added"])
+
+    return subject_set_id, display_name, saved, added
+
+
+def get_subject_set(
+    project, display_name, manifest_path=None, subject_set_cls=SubjectSet
+):
+    """Create a subject set, or find the one of an interrupted upload with the same name
+    :param project: the Zooniverse project
+    :param display_name: name of the new subject set
+    :param manifest_path: path of the manifest of the upload
+    :param subject_set_cls: class of the subject sets, replaceable by a fake
+    :return: the subject set
+    """
+    subject_set_id, manifest_name, _, _ = load_manifest(manifest_path)
+    if subject_set_id is not None:
+        if manifest_name == display_name:
+            print(f"Resuming the upload to subject set {subject_set_id}")
+            return subject_set_cls.find(subject_set_id)
+
+        # Set aside the manifest of an upload to another subject set
+        print(
+            f"Not resuming the upload to subject set {subject_set_id} ({manifest_name}), it is not {display_name}"
+        )
+        os.replace(manifest_path, f"{manifest_path}.{subject_set_id}.stale")
+
+    subject_set = subject_set_cls()
+    subject_set.links.project = project
+    subject_set.display_name = display_name
+    subject_set.save()
+
+    if manifest_path is not None:
+        with open(manifest_path, "a") as f:
+            f.write(
+                json.dumps(
+                    {"subject_set_id": subject_set.id, "display_name": display_name}
+                )
+                + "\n"
+            )
+
+    print("Zooniverse subject set created")
+    return subject_set
+
+
+@profile_utils.timed("upload")
+def upload_subjects(
+    project,
+    subject_set,
+    subject_metadata,
+    manifest_path=None,
+    n_workers=8,
+    batch_size=100,
+    n_retries=5,
+    subject_cls=Subject,
+):
+    """Upload files as subjects of a subject set, saving several subjects at once.
+        Saved and added subjects are recorded in the manifest so that an
+        interrupted upload can be resumed by calling the function again
+    :param project: the Zooniverse project
+    :param subject_set: the subject set hosting the subjects
+    :param subject_metadata: dict of filenames to their metadata
+    :param manifest_path: path of the manifest of the upload, None to disable resuming
+    :param n_workers: number of subjects saved at the same time
+    :param batch_size: number of subjects added to the subject set at once
+    :param n_retries: number of attempts of each request
+    :param subject_cls: class of the subjects, replaceable by a fake
+    :return: list of the subject ids
+    """
+    _, _, saved, added = load_manifest(manifest_path)
+    lock = threading.Lock()
+
+    def record(entry):
+        if manifest_path is not None:
+            with lock, open(manifest_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+
+    def save_subject(filename, metadata):
+        subject = subject_cls()
+        subject.links.project = project
+        subject.add_location(filename)
+        subject.metadata.update(metadata)
+        retry(subject.save, n_retries)
+        record({"filename": filename, "subject_id": subject.id})
+        with lock:
+            saved[filename] = subject.id
+        return subject.id
+
+    def add_subjects(subject_ids):
+        retry(lambda: subject_set.add(subject_ids), n_retries)
+        record({"added": subject_ids})
+        added.update(subject_ids)
+
+    # Add the subjects saved but not added by an interrupted upload
+    to_add = [i for f, i in saved.items() if f in subject_metadata and i not in added]
+
+    pending = {f: m for f, m in subject_metadata.items() if f not in saved}
+    print(f"{len(subject_metadata) - len(pending)} subjects already uploaded")
+
+    # Save the new subjects and add them to the subject set in batches
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(save_subject, f, m) for f, m in pending.items()]
+        for future in as_completed(futures):
+            to_add.append(future.result())
+            if len(to_add) >= batch_size:
+                add_subjects(to_add)
+                to_add = []
+
+    if len(to_add) > 0:
+        add_subjects(to_add)
+
+    return [saved[f] for f in subject_metadata]
+
+
+def close_manifest(manifest_path):
+    """Archive the manifest of a finished upload so that the next upload starts a new subject set"""
+    if manifest_path is not None and os.path.isfile(manifest_path):
+        subject_set_id, _, _, _ = load_manifest(manifest_path)
+        os.replace(manifest_path, f"{manifest_path}.{subject_set_id}.done")